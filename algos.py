@@ -16,83 +16,218 @@
 # along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import math
+import os
 import string
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 import pybedtools
 
-
-def window_maker(list_name, filled_list, window_size, slide_size):
-    """Make a bed file of sliding windows."""
-    for scaffold, start, end in filled_list:
-        width = window_size
-        step = slide_size
-
-        if width <= end:
-            list_name.append((scaffold, start, width))
-        else:
-            list_name.append((scaffold, start, end))
-
-        while width <= end:
-            start += step
-            width += step
-            if width >= end:
-                list_name.append((scaffold, start, end))
-            else:
-                list_name.append((scaffold, start, width))
-    return list_name
-
-
-def cluster_composer(pre_cluster_object, pre_cluster_intersection):
-    final_list = []
-    """Find real feature's positions."""
-    tmp = []
-    for item in pre_cluster_object:
-        scaffold = str(item[0])
-        for line in pre_cluster_intersection:
-            line = str(line)
-            if line.split()[0] == scaffold and (int(item[1]) <= int(line.split()[1]) <= int(item[2]) and int(item[1]) <= int(line.split()[2]) <= int(item[2])):
-                tmp.append(int(line.split()[1]))
-                tmp.append(int(line.split()[2]))
-            else:
-                continue
-        final_list.append((scaffold, min(tmp), max(tmp)))
-        tmp = []
-    return final_list
+from profiling import category_timer, drain_worker, merge_worker, record_tempfiles
 
 
-'''
-def seed_extender(new_list, indexes, intersection, limit):
-    """Extends culster's seeds."""
-    for index in indexes:
-        cluster_pos = []
-        scaffold = intersection[index][0]
-        right_step = index
-        left_step = index
-        while int(intersection[left_step][3]) >= limit and intersection[left_step][0] == scaffold:
-            if int(intersection[left_step][1]) not in cluster_pos:
-                cluster_pos.append(int(intersection[left_step][1]))
-            if (left_step - 1) >= 0:
-                left_step -= 1
-            else:
-                break
-        while int(intersection[right_step][3]) >= limit and intersection[right_step][0] == scaffold:
-            if int(intersection[right_step][2]) not in cluster_pos:
-                cluster_pos.append(int(intersection[right_step][2]))
-            if (right_step + 1) <= max(indexes):
-                right_step += 1
-            else:
-                break
-        cluster = (str(scaffold), min(cluster_pos), max(cluster_pos))
-        if cluster not in new_list:
-            new_list.append(cluster)
-    return new_list
-'''
-
+def window_maker(filled_list, window_size, slide_size):
+    """Make sliding windows as start/end arrays for each chromosome."""
+    windows = []
+    for scaffold, start, end in filled_list:
+        # the first window is always made, then one more for each slide
+        # while the previous window did not pass the chromosome end
+        n = 1
+        if window_size <= end:
+            n += (end - window_size) // slide_size + 1
+
+        steps = np.arange(n, dtype=np.int64) * slide_size
+        windows.append((scaffold, start + steps, np.minimum(window_size + steps, end)))
+    return windows
+
+
+def window_bed(windows):
+    """Write windows made by window_maker as a bed file."""
+    def intervals():
+        for scaffold, starts, ends in windows:
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                yield scaffold, start, end
+
+    return pybedtools.BedTool(intervals()).saveas()
+
+
+def window_counts(windows, catList, pdTbl):
+    """Count the features of each category overlapping each window.
+
+    The counts form a sparse (windows x categories) matrix in CSC layout,
+    returned as (cats, indptr, indices, data): the non-zero counts of the
+    j-th category of cats are data[indptr[j]:indptr[j + 1]], found in the
+    windows numbered by indices (windows are numbered in window_maker order).
+    """
+    cats = pd.Index(pd.unique(catList))
+    df = pdTbl[pdTbl.category.isin(cats)]
+    cat_codes = cats.get_indexer(df.category.values)
+    start = df.start.values.astype(np.int64)
+    end = df.end.values.astype(np.int64)
+
+    chroms = pd.Index([scaffold for scaffold, starts, ends in windows])
+    chr_codes = chroms.get_indexer(df.chr.values)
+    offsets = np.cumsum([0] + [len(starts) for scaffold, starts, ends in windows])
+
+    # the windows overlapping a feature go from the first one ending after
+    # its start to the last one starting before its end
+    first = np.zeros(len(df), dtype=np.int64)
+    last = np.zeros(len(df), dtype=np.int64)
+    order = np.argsort(chr_codes, kind='mergesort')
+    bounds = np.searchsorted(chr_codes[order], np.arange(len(windows) + 1))
+    for code, (scaffold, starts, ends) in enumerate(windows):
+        idx = order[bounds[code]:bounds[code + 1]]
+        first[idx] = offsets[code] + np.searchsorted(ends, start[idx], side='right')
+        last[idx] = offsets[code] + np.searchsorted(starts, end[idx], side='left')
+
+    # one (category, window) pair for each overlap, then count the pairs
+    n = np.maximum(last - first, 0)
+    win = np.repeat(first - np.cumsum(n) + n, n) + np.arange(n.sum())
+    keys, data = np.unique(np.repeat(cat_codes, n) * offsets[-1] + win, return_counts=True)
+
+    indptr = np.searchsorted(keys // offsets[-1], np.arange(len(cats) + 1))
+    return cats, indptr, keys % offsets[-1], data
+
+
+def _trim_runs(cl_seg, cl_start, cl_end, ft_seg, ft_start, ft_end):
+    """Span of the features fully contained in each interval.
+
+    Intervals sharing a segment code must not overlap. Returns the trimmed
+    start/end of every interval and the number of features it contains.
+    """
+    span = int(max(cl_end.max(), ft_end.max())) + 1
+    cl_first = cl_seg.astype(np.int64) * span + cl_start
+    cl_last = cl_seg.astype(np.int64) * span + cl_end
+    ft_first = ft_seg.astype(np.int64) * span + ft_start
+    ft_last = ft_seg.astype(np.int64) * span + ft_end
+
+    # the only interval which can contain a feature is the last one starting
+    # at or before the feature start
+    order = np.argsort(cl_first, kind='mergesort')
+    pos = np.searchsorted(cl_first[order], ft_first, side='right') - 1
+    hit = pos >= 0
+    hit[hit] = ft_last[hit] <= cl_last[order][pos[hit]]
+    idx = order[pos[hit]]
+
+    start = np.full(len(cl_start), np.iinfo(np.int64).max, dtype=np.int64)
+    end = np.full(len(cl_start), -1, dtype=np.int64)
+    np.minimum.at(start, idx, ft_start[hit])
+    np.maximum.at(end, idx, ft_end[hit])
+    return start, end, np.bincount(idx, minlength=len(cl_start))
+
+
+def cluster_trimmer(pre_clusters, features):
+    """Find real feature's positions.
+
+    Each pre-cluster (chr, start, end) is shrunk to the most 5' start and the
+    most 3' end of the features lying entirely inside it; pre-clusters without
+    such features are dropped.
+    """
+    cl_chr, cl_start, cl_end = [pre_clusters.iloc[:, i].values for i in range(3)]
+    ft_chr, ft_start, ft_end = [features.iloc[:, i].values for i in range(3)]
+
+    chroms = pd.Index(pd.unique(np.r_[cl_chr.astype(str), ft_chr.astype(str)]))
+    start, end, n = _trim_runs(chroms.get_indexer(cl_chr.astype(str)), cl_start.astype(np.int64), cl_end.astype(np.int64),
+                               chroms.get_indexer(ft_chr.astype(str)), ft_start.astype(np.int64), ft_end.astype(np.int64))
+
+    keep = n > 0
+    return pd.DataFrame({0: cl_chr.astype(str)[keep], 1: start[keep], 2: end[keep]})
+
+
+def release_tempfiles(keep):
+    """Delete the pybedtools temp files made after the first keep ones.
+
+    The size of all the temp files alive is recorded before, as they only
+    grow between two calls.
+    """
+    tempfiles = pybedtools.BedTool.TEMPFILES
+    record_tempfiles(sum(os.path.getsize(fn) for fn in tempfiles if os.path.exists(fn)))
+
+    while len(tempfiles) > keep:
+        fn = tempfiles.pop()
+        if os.path.exists(fn):
+            os.unlink(fn)
+
+
+def category_groups(catList, pdTbl):
+    """Yield the features of each category, grouping the table in one pass.
+
+    The temp files made while a category is processed are deleted as soon as
+    the next one is asked for.
+    """
+    groups = pdTbl.groupby('category', sort=False).indices
 
-def do_clusterdist(catList, pdTbl, tbl, sargs):
     for category in catList:
-        df = pdTbl[pdTbl.category == category]
+        done = category_timer(category)
+        keep = len(pybedtools.BedTool.TEMPFILES)
+        yield category, pdTbl.iloc[groups.get(category, [])]
+        release_tempfiles(keep)
+        if done is not None:
+            done()
+
+
+_shared = {}
+
+
+def _init_worker(func, args):
+    """Keep the shared arguments of run_threads in the worker process."""
+    _shared['func'] = func
+    _shared['args'] = args
+    _shared['tempfiles'] = len(pybedtools.BedTool.TEMPFILES)
+    # records inherited from the parent are not ours
+    drain_worker()
+
+
+def _run_shard(catList):
+    """Run the shared function on a shard of categories, with what the worker recorded meanwhile."""
+    try:
+        tables = list(_shared['func'](catList, *_shared['args']))
+    finally:
+        # workers never reach the pybedtools cleanup at exit
+        release_tempfiles(_shared['tempfiles'])
+    return tables, drain_worker()
+
+
+def run_threads(threads, func, catList, *args):
+    """Run one of the do_* functions on shards of catList in parallel.
+
+    args are the remaining arguments of func. Shards are contiguous slices of
+    catList and their tables are yielded in the same order, so the result is
+    the same as a serial run.
+    """
+    if threads <= 1 or len(catList) <= 1:
+        for df in func(catList, *args):
+            yield df
+        return
+
+    # a few shards per process keep the pool busy when categories differ in size
+    size = -(-len(catList) // (threads * 4))
+    shards = [catList[i:i + size] for i in range(0, len(catList), size)]
+
+    pool = Pool(min(threads, len(shards)), _init_worker, (func, args))
+    try:
+        for tables, recorded in pool.imap(_run_shard, shards):
+            merge_worker(recorded)
+            for df in tables:
+                yield df
+    finally:
+        pool.close()
+        pool.join()
+
+
+def collect(tables):
+    """Concatenate the tables yielded by the do_* functions at once."""
+    # empty tables would turn integer columns into floats
+    tables = [df for df in tables if not df.empty]
+    if not tables:
+        return pd.DataFrame()
+    return pd.concat(tables)
+
+
+def do_clusterdist(catList, pdTbl, sargs):
+    for category, df in category_groups(catList, pdTbl):
         BEDtools_object = pybedtools.BedTool().from_dataframe(df).sort()
 
         try:
@@ -102,51 +237,245 @@ def do_clusterdist(catList, pdTbl, tbl, sargs):
 
         df = pd.read_table(merge.fn, header=None)
         df[4] = category
-        tbl = tbl.append(df)
+        yield df
 
-    return tbl
 
+def _merge_runs(group, start, end, dist):
+    """Label runs of intervals closer than dist (same rule as bedtools merge -d).
 
-def do_clustermean(catList, pdTbl, tbl, sargs):
-    loc = list(pdTbl.chr.unique())
-    chr_len = []
+    Intervals must be sorted by group and start; a run never spans two groups.
+    """
+    # shift each group far apart so that a single cumulative max gives the
+    # furthest end reached so far inside the group
+    offset = group.astype(np.int64) * (int(end.max()) + dist + 1)
+    reach = np.maximum.accumulate(end + offset) - offset
 
-    for chr in loc:
-        df = pdTbl[pdTbl.chr == chr]
-        chr_len.append((chr, 0, max(df.end)))
+    new = np.ones(len(start), dtype=bool)
+    new[1:] = (group[1:] != group[:-1]) | (start[1:] - reach[:-1] > dist)
+    return np.cumsum(new) - 1
 
-    windows = []
-    window_maker(windows, chr_len, int(sargs['--window']), int(sargs['--slide']))
-    win_bed = pybedtools.BedTool(windows)
+
+def _count_distinct(runs, codes):
+    """Count the distinct codes found in each run."""
+    base = int(codes.max()) + 1
+    pairs = np.unique(runs * base + codes)
+    return np.bincount(pairs // base, minlength=runs[-1] + 1)
+
+
+def sort_features(catList, pdTbl):
+    """Features of catList as arrays sorted by category, chromosome and start.
+
+    Chromosomes are sorted lexicographically, as bedtools does.
+    """
+    cats = pd.Index(pd.unique(catList))
+    df = pdTbl[pdTbl.category.isin(cats)]
+
+    cat_codes = cats.get_indexer(df.category.values)
+    chroms, chr_codes = np.unique(df.chr.values.astype(str), return_inverse=True)
+    start = df.start.values.astype(np.int64)
+    end = df.end.values.astype(np.int64)
+    names = pd.factorize(df.name.values)[0]
+
+    order = np.lexsort((start, chr_codes, cat_codes))
+    return {'cats': cats, 'chroms': chroms,
+            'category': cat_codes[order], 'chr': chr_codes[order],
+            'start': start[order], 'end': end[order], 'name': names[order]}
+
+
+def do_clusterdist_numpy(catList, pdTbl, sargs, features=None):
+    """Same as do_clusterdist, computed in memory for all categories at once.
+
+    features may be given as made by sort_features for catList or for a
+    longer list of categories, to share the sorting between runs.
+    """
+    dist = int(sargs['--dist'])
+
+    if features is None:
+        features = sort_features(catList, pdTbl)
+    cats = features['cats']
+    keep = np.in1d(features['category'], cats.get_indexer(pd.unique(catList)))
+    if not keep.any():
+        return
+
+    cat_codes, chr_codes = features['category'][keep], features['chr'][keep]
+    start, end, names = features['start'][keep], features['end'][keep], features['name'][keep]
+
+    # every (category, chromosome) pair is a segment of its own
+    runs = _merge_runs(cat_codes * len(features['chroms']) + chr_codes, start, end, dist)
+    first = np.flatnonzero(np.diff(np.r_[-1, runs]))
+
+    yield pd.DataFrame({0: features['chroms'][chr_codes[first]],
+                        1: start[first],
+                        2: np.maximum.reduceat(end, first),
+                        3: _count_distinct(runs, names),
+                        4: cats.values[cat_codes[first]]})
+
+
+def mean_windows(pdTbl, sargs):
+    """Sliding windows over the chromosomes of pdTbl, up to their last feature."""
+    chr_end = pdTbl.groupby('chr', sort=False).end.max()
+    chr_len = [(chr, 0, end) for chr, end in chr_end.iteritems()]
+
+    return window_maker(chr_len, int(sargs['--window']), int(sargs['--slide']))
+
+
+def _zscore_minimum(total, squares, n, k):
+    """Smallest integer count c with c >= mean + k * stdv of n window counts.
+
+    total and squares are the sums of the counts and of their squares, stdv
+    is the sample one (as pandas). The comparison
+    (n*c - total)**2 * (n - 1) >= k**2 * n * (n*squares - total**2), with
+    n*c >= total, is made on integers, so that it is exact.
+    """
+    spread = k * k * n * (n * squares - total * total)
+
+    def above(c):
+        return n * c >= total and (n * c - total) ** 2 * (n - 1) >= spread
+
+    # start from the float threshold and fix its rounding
+    c = int(math.ceil(total / float(n) + math.sqrt(max(spread, 0) / float(n * n * (n - 1)))))
+    while c > 0 and above(c - 1):
+        c -= 1
+    while not above(c):
+        c += 1
+    return c
+
+
+def seed_extender(catList, pdTbl, sargs, windows, counts):
+    """Same as the bedtools steps of do_clustermean, computed in memory for all categories at once.
+
+    counts are made by window_counts over windows. Extension windows are
+    merged into runs (book-ended ones too, as bedtools merge), the runs
+    overlapping a seed window are trimmed to the features they contain and
+    the features overlapping each trimmed cluster are counted.
+    """
+    cats, indptr, indices, data = counts
+    win_seg = np.repeat(np.arange(len(windows)), [len(starts) for scaffold, starts, ends in windows])
+    win_start = np.concatenate([starts for scaffold, starts, ends in windows])
+    win_end = np.concatenate([ends for scaffold, starts, ends in windows])
+    n = len(win_start)
+
+    # extension and seed windows of each category, numbered in catList order
+    wanted = pd.Index(pd.unique(catList))
+    ext, seed = [], []
+    for k, category in enumerate(wanted):
+        j = cats.get_loc(category)
+        hit, values = indices[indptr[j]:indptr[j + 1]], data[indptr[j]:indptr[j + 1]]
+        total = int(values.sum())
+        squares = int((values.astype(np.int64) ** 2).sum())
+        if total == 0 or n < 2:
+            continue
+        multi1 = _zscore_minimum(total, squares, n, int(sargs['--seed']))
+        multi2 = _zscore_minimum(total, squares, n, int(sargs['--extension']))
+        seed.append(k * n + hit[values >= multi1])
+        ext.append(k * n + hit[values >= multi2])
+    ext, seed = np.concatenate(ext or [[]]).astype(np.int64), np.concatenate(seed or [[]]).astype(np.int64)
+    if len(seed) == 0 or len(ext) == 0:
+        return
+
+    # every (category, chromosome) pair is a segment of its own, numbered in
+    # window order so that windows sorted by number are sorted by segment
+    ext_seg = ext // n * len(windows) + win_seg[ext % n]
+    seed_seg = seed // n * len(windows) + win_seg[seed % n]
+    ext, seed = ext % n, seed % n
+
+    runs = _merge_runs(ext_seg, win_start[ext], win_end[ext], 0)
+    first = np.flatnonzero(np.diff(np.r_[-1, runs]))
+    run_seg, run_start, run_end = ext_seg[first], win_start[ext][first], np.maximum.reduceat(win_end[ext], first)
+
+    # window ends grow with their starts, so the first seed ending after the
+    # run start is the only one to check (runs always hold features, as
+    # extension windows are not empty)
+    span = int(win_end.max()) + 1
+    pos = np.searchsorted(seed_seg * span + win_end[seed], run_seg * span + run_start, side='right')
+    pos = np.minimum(pos, len(seed) - 1)
+    keep = (seed_seg[pos] == run_seg) & (win_start[seed][pos] < run_end) & (win_end[seed][pos] > run_start)
+    run_seg, run_start, run_end = run_seg[keep], run_start[keep], run_end[keep]
+
+    # features of the categories in the same segments
+    df = pdTbl[pdTbl.category.isin(wanted)]
+    chroms = pd.Index([str(scaffold) for scaffold, starts, ends in windows])
+    chr_codes = chroms.get_indexer(df.chr.values.astype(str))
+    df, chr_codes = df[chr_codes != -1], chr_codes[chr_codes != -1]
+    ft_seg = wanted.get_indexer(df.category.values).astype(np.int64) * len(windows) + chr_codes
+    ft_start = df.start.values.astype(np.int64)
+    ft_end = df.end.values.astype(np.int64)
+    if len(run_seg) == 0 or len(ft_seg) == 0:
+        return
+
+    start, end, contained = _trim_runs(run_seg, run_start, run_end, ft_seg, ft_start, ft_end)
+    keep = contained > 0
+    seg, start, end = run_seg[keep], start[keep], end[keep]
+    if len(seg) == 0:
+        return
+
+    # features overlapping a trimmed cluster start before its end and end
+    # after its start
+    span = int(max(end.max(), ft_end.max())) + 1
+    starts = np.sort(ft_seg * span + ft_start)
+    ends = np.sort(ft_seg * span + ft_end)
+    overlapping = np.searchsorted(starts, seg * span + end, side='left') - \
+        np.searchsorted(ends, seg * span + start, side='right')
+
+    yield pd.DataFrame({0: chroms.values[seg % len(windows)],
+                        1: start,
+                        2: end,
+                        3: overlapping,
+                        4: wanted.values[seg // len(windows)]})
+
+
+def do_clustermean(catList, pdTbl, sargs, windows=None, counts=None):
+    """Find clusters of windows denser than the category mean.
+
+    windows (made by mean_windows) and counts (made by window_counts for
+    catList or for a longer list of categories) may be given to share them
+    between runs; given counts are used whatever the engine, and the clusters
+    are then found by seed_extender.
+    """
+    if windows is None:
+        windows = mean_windows(pdTbl, sargs)
+
+    if counts is None and sargs['--engine'] == 'numpy':
+        # count every category in memory at once
+        counts = window_counts(windows, catList, pdTbl)
+
+    if counts is not None:
+        # seeds are extended and trimmed in memory, without bedtools
+        for df in seed_extender(catList, pdTbl, sargs, windows, counts):
+            yield df
+        return
+
+    win_bed = window_bed(windows)
 
     # for each category compute clusters
-    for category in catList:
+    for category, features in category_groups(catList, pdTbl):
         # print category
-        df = pdTbl[pdTbl.category == category]
-        BEDtools_object = pybedtools.BedTool().from_dataframe(df)
+        BEDtools_object = pybedtools.BedTool().from_dataframe(features)
 
-        # intersect features to windows
+        # count features in windows
         try:
             intersect_bed = win_bed.intersect(BEDtools_object, c=True)
         except:
             continue
 
         df = pd.read_table(intersect_bed.fn, header=None, dtype={0: str})
+        n = len(df)
         df[4] = category
 
-        # compute mean and stdv feature density per-window
-        mean = df[3].mean()
-        stdv = df[3].std()
-
-        multi1 = mean + (int(sargs['--seed'])*stdv)
-        multi2 = mean + (int(sargs['--extension'])*stdv)
+        # smallest feature counts of seed and extension windows, from the
+        # mean and stdv feature density per-window (empty windows included)
+        total = int(df[3].sum())
+        squares = int((df[3].values.astype(np.int64) ** 2).sum())
+        if total == 0 or n < 2:
+            continue
+        multi1 = _zscore_minimum(total, squares, n, int(sargs['--seed']))
+        multi2 = _zscore_minimum(total, squares, n, int(sargs['--extension']))
 
         # extract seeds and try to extend them
-        seed_list = df[df[3] >= multi1].index.tolist()
-
-        #NUOVO
         df_seed = df.loc[df[3] >= multi1]
         df_ext = df.loc[df[3] >= multi2]
+        if df_seed.empty:
+            continue
         BEDtools_seed = pybedtools.BedTool().from_dataframe(df_seed)
         BEDtools_ext = pybedtools.BedTool().from_dataframe(df_ext)
 
@@ -166,24 +495,261 @@ def do_clustermean(catList, pdTbl, tbl, sargs):
         except:
             continue
 
-        features_in_clusters = BEDtools_object.intersect(pre_clusters, wa=True)
+        try:
+            pre_clusters = pd.read_table(pre_clusters.fn, header=None, dtype={0: str})
+        except:
+            continue
+
+        final_list = cluster_trimmer(pre_clusters, features)
+        if final_list.empty:
+            continue
 
-        final_list = cluster_composer(pre_clusters, features_in_clusters)
-        clusters = pybedtools.BedTool(final_list)
+        clusters = pybedtools.BedTool().from_dataframe(final_list)
         final_clusters = clusters.intersect(BEDtools_object, c=True)
 
         tclusters = pd.read_table(final_clusters.fn, header=None)
         tclusters[4] = category
-        tbl = tbl.append(tclusters)
-
-    return tbl
-
-
-def do_singletons(catList, pdTbl, clustersTbl, emptyTbl, sargs):
-    for category in catList:
+        yield tclusters
+
+
+def find_clusters(method, l, pdtable, sargs, threads=1):
+    """Join the raw clusters of the categories of l, found by clusterdist (dist) or clustermean (mean)."""
+    if method == 'dist' and sargs['--engine'] == 'numpy':
+        tables = run_threads(threads, do_clusterdist_numpy, l, pdtable, sargs)
+    elif method == 'dist':
+        tables = run_threads(threads, do_clusterdist, l, pdtable, sargs)
+    else:
+        tables = run_threads(threads, do_clustermean, l, pdtable, sargs)
+
+    # join the per-category tables at once
+    return collect(tables)
+
+
+def clustered_counts(features, dist, nf, shuffles=None):
+    """Number of features in clusters of at least nf features, for each category.
+
+    features are made by sort_features. shuffles is an optional list of
+    permutations of the category labels of features; the counts of all of
+    them (one row each) are then found with a single sort, as if each
+    shuffle was a set of categories of its own.
+    """
+    ncat, nchr = len(features['cats']), len(features['chroms'])
+    if shuffles is None:
+        labels = features['category'][np.newaxis, :]
+    else:
+        labels = np.vstack([features['category'][shuffle] for shuffle in shuffles])
+    k = len(labels)
+
+    group = (np.arange(k)[:, np.newaxis] * ncat + labels).ravel()
+    chr_codes = np.tile(features['chr'], k)
+    start, end = np.tile(features['start'], k), np.tile(features['end'], k)
+    names = np.tile(features['name'], k)
+    order = np.lexsort((start, chr_codes, group))
+    group, chr_codes, start, end, names = group[order], chr_codes[order], start[order], end[order], names[order]
+
+    runs = _merge_runs(group * nchr + chr_codes, start, end, dist)
+    first = np.flatnonzero(np.diff(np.r_[-1, runs]))
+    n = _count_distinct(runs, names)
+    clustered = n >= nf
+
+    counts = np.bincount(group[first][clustered], weights=n[clustered], minlength=k * ncat)
+    return counts.reshape(k, ncat).astype(np.int64)
+
+
+def clustered_table(table, l, nf):
+    """Number of features in clusters of at least nf features for each category of l, from a raw cluster table."""
+    if table.empty:
+        return np.zeros(len(l), dtype=np.int64)
+    table = table[table[3] >= nf]
+    return table.groupby(4)[3].sum().reindex(l).fillna(0).values.astype(np.int64)
+
+
+def empirical_pvalues(observed, batches):
+    """(1 + shuffles with at least the observed count) / (1 + shuffles), for each category.
+
+    batches are arrays of counts with one row per shuffle and one column per
+    category, as observed.
+    """
+    hits, permutations = np.zeros(len(observed), dtype=np.int64), 0
+    for counts in batches:
+        hits += (counts >= observed).sum(axis=0)
+        permutations += len(counts)
+    return (1.0 + hits) / (1.0 + permutations)
+
+
+def bh_fdr(pvalues):
+    """Benjamini-Hochberg adjusted p-values."""
+    pvalues = np.asarray(pvalues, dtype=float)
+    order = np.argsort(pvalues)[::-1]
+    n = len(pvalues)
+    adjusted = np.minimum.accumulate(pvalues[order] * n / np.arange(n, 0, -1))
+    fdr = np.empty(n)
+    fdr[order] = np.minimum(adjusted, 1)
+    return fdr
+
+
+_permutations = {}
+
+
+def _init_permutations(args):
+    """Keep the arguments of permutation_test in the worker process."""
+    _permutations['args'] = args
+
+
+def _permutation_batch(job):
+    """Clustered features of the categories of l in a batch of label shuffles."""
+    seed, size = job
+    method, l, pdtable, sargs, nf, features = _permutations['args']
+    rng = np.random.RandomState(seed)
+
+    if features is not None:
+        # all the shuffles of the batch at once
+        shuffles = [rng.permutation(len(features['category'])) for i in range(size)]
+        counts = clustered_counts(features, int(sargs['--dist']), nf, shuffles)
+        return counts[:, features['cats'].get_indexer(l)]
+
+    counts = []
+    for i in range(size):
+        shuffled = pdtable.copy()
+        shuffled['category'] = pdtable.category.values[rng.permutation(len(pdtable))]
+        shuffled = shuffled.drop_duplicates(['name', 'category'])
+        counts.append(clustered_table(find_clusters(method, l, shuffled, sargs), l, nf))
+    return np.vstack(counts)
+
+
+def permutation_test(method, l, pdtable, clustersTbl, sargs, nf, permutations, seed=None, threads=1, batch=16):
+    """Empirical p-values of the number of features in clusters of each category of l.
+
+    clustersTbl is the raw cluster table already found for l (as joined by
+    collect), which gives the observed counts. Category labels are shuffled
+    among the rows of pdtable, keeping the size of every category, and the
+    clusters searched again permutations times (batch shuffles at a time, in
+    a pool of threads processes). P-values are computed by empirical_pvalues.
+    Returns a table of category, p_value and fdr (Benjamini-Hochberg over the
+    categories of l).
+    """
+    observed = clustered_table(clustersTbl, l, nf)
+    features = None
+    if method == 'dist' and sargs['--engine'] == 'numpy':
+        features = sort_features(list(pdtable.category.unique()), pdtable)
+
+    # one seed per batch, so that results don't depend on threads
+    rng = np.random.RandomState(seed)
+    sizes = [min(batch, permutations - i) for i in range(0, permutations, batch)]
+    jobs = list(zip(rng.randint(0, 2 ** 31 - 1, len(sizes)), sizes))
+    args = (method, l, pdtable, sargs, nf, features)
+
+    if threads <= 1 or len(jobs) <= 1:
+        _init_permutations(args)
+        batches = [_permutation_batch(job) for job in jobs]
+    else:
+        pool = Pool(min(threads, len(jobs)), _init_permutations, (args,))
+        try:
+            batches = pool.map(_permutation_batch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    pvalues = empirical_pvalues(observed, batches)
+
+    return pd.DataFrame({'category': list(l), 'p_value': pvalues, 'fdr': bh_fdr(pvalues)},
+                        columns=['category', 'p_value', 'fdr'])
+
+
+def _sorted_singletons(st, catList):
+    """Order singletons as do_singletons does: by category of catList, then as sorted by bedtools."""
+    cat_codes = pd.Index(pd.unique(catList)).get_indexer(st.category.values)
+    chr_codes = np.unique(st.chr.values.astype(str), return_inverse=True)[1]
+    return st.iloc[np.lexsort((st.start.values, chr_codes, cat_codes))]
+
+
+def feature_assigner(all_features, clusters, singletons=None):
+    """Split the features overlapping clusters into cluster features and bystanders.
+
+    all_features has one row per feature and category, clusters is the
+    numbered cluster table. A feature overlapping a cluster belongs to it if
+    it shares the cluster category, otherwise it is a bystander. Overlaps are
+    searched once per feature, whatever the number of its categories. Both
+    tables are returned with the columns chr, start, end, name, strand,
+    cluster_id and category (of the cluster), ordered by feature and cluster.
+
+    The third table returned holds the singletons of the categories listed
+    in singletons (None if not given): rows of all_features of those
+    categories outside every cluster of their own category, ordered as
+    do_singletons does.
+    """
+    columns = ["chr", "start", "end", "name", "strand", "cluster_id", "category"]
+    if clusters.empty or all_features.empty:
+        st = None
+        if singletons is not None:
+            st = _sorted_singletons(all_features[all_features.category.isin(singletons)], singletons)
+        return pd.DataFrame(columns=columns), pd.DataFrame(columns=columns), st
+
+    # the first row of each feature gives its position
+    name_codes = pd.factorize(all_features.name.values)[0]
+    loci = all_features.iloc[np.unique(name_codes, return_index=True)[1]]
+
+    # (feature, category) pairs of the annotation
+    cats = pd.Index(pd.unique(np.r_[all_features.category.values, clusters.category.values]))
+    row_cat = cats.get_indexer(all_features.category.values)
+    row_keys = name_codes.astype(np.int64) * len(cats) + row_cat
+    annotated = np.unique(row_keys)
+
+    # positions of features and clusters on a single axis, chromosome after chromosome
+    chroms = pd.Index(pd.unique(np.r_[loci.chr.values.astype(str), clusters.chr.values.astype(str)]))
+    span = int(max(loci.end.max(), clusters.end.max())) + 1
+    ft_chr = chroms.get_indexer(loci.chr.values.astype(str))
+    cl_chr = chroms.get_indexer(clusters.chr.values.astype(str))
+    ft_start = ft_chr.astype(np.int64) * span + loci.start.values
+    ft_end = ft_chr.astype(np.int64) * span + loci.end.values
+    cl_start = cl_chr.astype(np.int64) * span + clusters.start.values
+    cl_end = cl_chr.astype(np.int64) * span + clusters.end.values
+
+    # a cluster overlapping a feature starts before the feature end and no
+    # further than the longest cluster of the chromosome before its start
+    longest = np.zeros(len(chroms), dtype=np.int64)
+    np.maximum.at(longest, cl_chr, cl_end - cl_start)
+    order = np.argsort(cl_start, kind='mergesort')
+    first = np.searchsorted(cl_start[order], ft_start - longest[ft_chr], side='right')
+    last = np.searchsorted(cl_start[order], ft_end, side='left')
+
+    n = np.maximum(last - first, 0)
+    ft = np.repeat(np.arange(len(loci)), n)
+    cl = order[np.repeat(first - np.cumsum(n) + n, n) + np.arange(n.sum())]
+    hit = cl_end[cl] > ft_start[ft]
+    ft, cl = ft[hit], cl[hit]
+    sort = np.lexsort((cl, ft))
+    ft, cl = ft[sort], cl[sort]
+
+    cl_cat = cats.get_indexer(clusters.category.values)
+    member = np.in1d(ft * len(cats) + cl_cat[cl], annotated)
+
+    def pairs(keep):
+        return pd.DataFrame({"chr": loci.chr.values[ft[keep]],
+                             "start": loci.start.values[ft[keep]],
+                             "end": loci.end.values[ft[keep]],
+                             "name": loci.name.values[ft[keep]],
+                             "strand": loci.strand.values[ft[keep]],
+                             "cluster_id": clusters.cluster_id.values[cl[keep]],
+                             "category": clusters.category.values[cl[keep]]},
+                            columns=columns)
+
+    st = None
+    if singletons is not None:
+        # categories without clusters have all their features as singletons
+        inside = ft[member] * len(cats) + cl_cat[cl[member]]
+        keep = all_features.category.isin(singletons).values & ~np.in1d(row_keys, inside)
+        st = _sorted_singletons(all_features[keep], singletons)
+
+    return pairs(member), pairs(~member), st
+
+
+def do_singletons(catList, pdTbl, clustersTbl, sargs):
+    clusters = dict(category_groups(catList, clustersTbl))
+
+    for category, df in category_groups(catList, pdTbl):
         try:
-            df = pdTbl[pdTbl.category == category]
-            df2 = clustersTbl[clustersTbl.category == category]
+            df2 = clusters[category]
 
             ft = pybedtools.BedTool().from_dataframe(df).sort()
             cl = pybedtools.BedTool().from_dataframe(df2).sort()
@@ -191,11 +757,10 @@ def do_singletons(catList, pdTbl, clustersTbl, emptyTbl, sargs):
             st = ft.intersect(cl, v=True)
 
             pdSt = pd.read_table(st.fn, header=None)
-            emptyTbl = emptyTbl.append(pdSt)
         except Exception as e:
             continue
 
-    return emptyTbl
+        yield pdSt
 
 
 '''
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Description:
+  Benchmark ClusterScan on a synthetic genome. Inputs are generated at the
+  requested scale, then each stage (load, clusterdist, clustermean,
+  bystanders, singletons) runs in a forked process and its wall time, CPU
+  time and peak memory are reported as JSON.
+
+Usage:
+  run.py [-o FILE] [--workdir PATH] [--stages LIST] [--engine NAME] [--chromosomes=<n>] [--length=<bp>] [--features=<n>] [--categories=<n>] [--density=<f>] [--seed=<n>] [--chunksize=<n>] [-n=<n>] [-d=<bp>] [-w=<bp>] [-s=<bp>] [-k=<n>] [-e=<n>]
+  run.py (-h | --help)
+
+Options:
+  -h, --help                        Show this screen.
+  -o, --output FILE                 JSON report, - for standard output [default: -].
+  --workdir PATH                    Keep the synthetic inputs in PATH instead of a temporary directory.
+  --stages LIST                     Comma separated list of stages to measure [default: load,clusterdist,clustermean,bystanders,singletons].
+  --engine NAME                     Interval engine, bedtools or numpy [default: bedtools].
+  --chromosomes=<n>                 Number of chromosomes [default: 5].
+  --length=<bp>                     Length of each chromosome [default: 50000000].
+  --features=<n>                    Number of features [default: 20000].
+  --categories=<n>                  Number of categories [default: 500].
+  --density=<f>                     Fraction of the annotation found in tandem runs of features [default: 0.3].
+  --seed=<n>                        Seed of the random generator [default: 0].
+  --chunksize=<n>                   Load the inputs <n> lines at a time.
+  -n, --nf=<n>                      Minimum number of features per cluster [default: 2].
+  -d, --dist=<bp>                   Maximum distance between features in bp [default: 500000].
+  -w, --window=<bp>                 Window size [default: 500000].
+  -s, --slide=<bp>                  Sliding size [default: 250000].
+  -k, --seed-sd=<n>                 Standard deviations of a seed window [default: 3].
+  -e, --extension=<n>               Standard deviations of an extension window [default: 2].
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from Queue import Empty
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import numpy as np
+import pandas as pd
+import pybedtools
+from docopt import docopt
+
+from algos import *
+from loader import *
+from clusterscan import cluster_annotator
+from profiling import peak_rss
+from synthetic import synthetic_genome
+
+STAGES = ['load', 'clusterdist', 'clustermean', 'bystanders', 'singletons']
+
+
+def _stage_child(queue, func, args):
+    """Run func in the forked process and send back its result and usage, or its error."""
+    tempfiles = len(pybedtools.BedTool.TEMPFILES)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    baseline = peak_rss(resource.RUSAGE_SELF)
+    wall = time.time()
+    try:
+        result = func(*args)
+    except Exception:
+        queue.put((None, None, traceback.format_exc()))
+        return
+    finally:
+        # forked processes never reach the pybedtools cleanup at exit
+        release_tempfiles(tempfiles)
+    wall = time.time() - wall
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+    # bedtools runs in child processes of its own
+    peak = peak_rss()
+    queue.put((result, {'wall_s': round(wall, 4),
+                        'cpu_s': round(cpu, 4),
+                        'peak_rss_mb': round(peak, 1),
+                        'rss_increase_mb': round(max(peak - baseline, 0), 1)}, None))
+
+
+def measure(stage, report, func, *args):
+    """Run func(*args) in a forked process when stage is measured, return its result.
+
+    The forked process starts from the memory of the current one, so its
+    peak memory increase is the memory needed by the stage alone.
+    """
+    if stage not in report['measured']:
+        return func(*args)
+
+    queue = Queue()
+    worker = Process(target=_stage_child, args=(queue, func, args))
+    worker.start()
+    while True:
+        try:
+            result, usage, error = queue.get(timeout=1)
+            break
+        except Empty:
+            if worker.is_alive():
+                continue
+        # the worker may have exited right after sending its result
+        try:
+            result, usage, error = queue.get(timeout=1)
+            break
+        except Empty:
+            raise RuntimeError('Stage %s died with exit code %s.' % (stage, worker.exitcode))
+    worker.join()
+    if error is not None:
+        raise RuntimeError('Stage %s failed:\n%s' % (stage, error))
+
+    usage['stage'] = stage
+    report['stages'].append(usage)
+    return result
+
+
+def clusters_stage(func, catList, pdTbl, sargs):
+    """Join the clusters of every category."""
+    return collect(func(catList, pdTbl, sargs))
+
+
+def bystanders_stage(table, all_features, nf, engine):
+    """Number the clusters, find their features and bystanders."""
+    return cluster_annotator(table.copy(), all_features, nf, None, engine)
+
+
+def singletons_stage(catList, pdTbl, all_features, bedTbl, sargs):
+    """Find the features outside the clusters of their category."""
+    if sargs['--engine'] == 'numpy':
+        return feature_assigner(all_features, bedTbl, catList)[2]
+    return collect(do_singletons(catList, pdTbl, bedTbl, sargs))
+
+
+def main():
+    measured = arguments['--stages'].split(',')
+    if not set(measured) <= set(STAGES):
+        raise SystemExit('Unknown stage in %s, please choose among %s.' % (arguments['--stages'], ','.join(STAGES)))
+    if arguments['--engine'] not in ['bedtools', 'numpy']:
+        raise SystemExit('Unknown engine %s, please choose between bedtools and numpy.' % (arguments['--engine']))
+
+    sargs = {'--engine': arguments['--engine'],
+             '--dist': arguments['--dist'],
+             '--window': arguments['--window'],
+             '--slide': arguments['--slide'],
+             '--seed': arguments['--seed-sd'],
+             '--extension': arguments['--extension']}
+    genome = {'chromosomes': int(arguments['--chromosomes']),
+              'length': int(arguments['--length']),
+              'features': int(arguments['--features']),
+              'categories': int(arguments['--categories']),
+              'density': float(arguments['--density']),
+              'seed': int(arguments['--seed'])}
+    report = {'measured': measured,
+              'genome': genome,
+              'parameters': dict((key.lstrip('-'), value) for key, value in sargs.items()),
+              'versions': {'python': platform.python_version(),
+                           'numpy': np.__version__,
+                           'pandas': pd.__version__},
+              'stages': []}
+
+    workdir = arguments['--workdir'] or tempfile.mkdtemp(prefix='clusterscan_bench_')
+    try:
+        features, annotation = synthetic_genome(workdir, **genome)
+
+        chunksize = None if arguments['--chunksize'] is None else int(arguments['--chunksize'])
+        all_features, n = measure('load', report, build_table, features, annotation, chunksize)
+        pdtable = all_features[all_features["category"] != "Unknown"]
+        l = list(pdtable.category.unique())
+        report['inputs'] = {'features': n, 'rows': len(all_features), 'categories': len(l)}
+
+        if arguments['--engine'] == 'numpy':
+            clusterdist = do_clusterdist_numpy
+        else:
+            clusterdist = do_clusterdist
+        table = measure('clusterdist', report, clusters_stage, clusterdist, l, pdtable, sargs)
+        report['inputs']['clusterdist_rows'] = len(table)
+
+        if 'clustermean' in measured:
+            mean = measure('clustermean', report, clusters_stage, do_clustermean, l, pdtable, sargs)
+            report['inputs']['clustermean_rows'] = len(mean)
+
+        if table.empty or not set(['bystanders', 'singletons']) & set(measured):
+            pass
+        else:
+            annotated = measure('bystanders', report, bystanders_stage, table, all_features,
+                                int(arguments['--nf']), arguments['--engine'])
+            table, bedTbl, cl_features, bystanders, summary, st = annotated
+            report['inputs']['clusters'] = len(table)
+
+            if 'singletons' in measured:
+                singletons = measure('singletons', report, singletons_stage, l, pdtable, all_features, bedTbl, sargs)
+                report['inputs']['singletons'] = len(singletons)
+    finally:
+        if arguments['--workdir'] is None:
+            shutil.rmtree(workdir)
+
+    del report['measured']
+    if arguments['--output'] == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True, separators=(',', ': '))
+        sys.stdout.write('\n')
+    else:
+        with open(arguments['--output'], 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True, separators=(',', ': '))
+
+
+# program execution
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main()
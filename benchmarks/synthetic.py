@@ -0,0 +1,88 @@
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def synthetic_features(chromosomes, length, features, rng):
+    """Random features spread over chromosomes of the given length, sorted by position."""
+    chrom = np.sort(rng.randint(0, chromosomes, features))
+    start = rng.randint(0, length, features)
+    order = np.lexsort((start, chrom))
+    chrom, start = chrom[order], start[order]
+    end = np.minimum(start + rng.randint(500, 20000, features), length)
+
+    return pd.DataFrame({'chr': ['chr%d' % (c + 1) for c in chrom],
+                         'start': start,
+                         'end': end,
+                         'name': ['gene%d' % (i + 1) for i in range(features)],
+                         'score': 0,
+                         'strand': rng.choice(['+', '-'], features)},
+                        columns=['chr', 'start', 'end', 'name', 'score', 'strand'])
+
+
+def synthetic_annotation(features, categories, density, rng):
+    """Annotate about one category per feature.
+
+    A density fraction of the pairs comes in runs of 2 to 8 neighbouring
+    features sharing a category (tandem clusters), the rest is spread at
+    random with a skewed category size, as in protein domain annotations.
+    Some features stay without category.
+    """
+    n = len(features)
+    clustered = int(density * n)
+
+    names, cats = [], []
+    while clustered > 0:
+        run = min(rng.randint(2, 9), clustered, n)
+        first = rng.randint(0, n - run + 1)
+        names.append(np.arange(first, first + run))
+        cats.append(np.repeat(rng.randint(0, categories), run))
+        clustered -= run
+
+    weights = 1.0 / np.arange(1, categories + 1)
+    spread = n - int(density * n)
+    names.append(rng.randint(0, n, spread))
+    cats.append(rng.choice(categories, spread, p=weights / weights.sum()))
+
+    names, cats = np.concatenate(names), np.concatenate(cats)
+    order = rng.permutation(len(names))
+
+    return pd.DataFrame({'name': features.name.values[names[order]],
+                         'category': ['CAT%05d' % (c + 1) for c in cats[order]]},
+                        columns=['name', 'category'])
+
+
+def synthetic_genome(path, chromosomes=5, length=50000000, features=20000, categories=500, density=0.3, seed=0):
+    """Write a random FEATURES bed and its ANNOTATION in path, return their file names."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    rng = np.random.RandomState(seed)
+
+    feat = synthetic_features(chromosomes, length, features, rng)
+    anno = synthetic_annotation(feat, categories, density, rng)
+
+    features_fn = os.path.join(path, 'features.bed')
+    annotation_fn = os.path.join(path, 'annotation.txt')
+    feat.to_csv(features_fn, sep='\t', header=False, index=False)
+    anno.to_csv(annotation_fn, sep='\t', header=False, index=False)
+
+    return features_fn, annotation_fn
@@ -21,10 +21,19 @@
 
 """Description:
   ClusterScan, search for clusters of features in a given annotation.
+  With sweep, -n, -d, -w, -s, -k and -e accept comma separated lists of values
+  and the analysis is repeated for every combination of them.
+  FEATURES and ANNOTATION may be gzip or bgzip compressed, and one of them
+  may be - to read it from the standard input.
+  With batch, each row of MANIFEST (tab separated FEATURES, ANNOTATION and
+  analysis name) is analyzed in a pool of -t processes, with its own prefix.
 
 Usage:
-  clusterscan.py clusterdist FEATURES ANNOTATION [-o PATH] [-a NAME] [-c LIST] [--info FILE] [--singletons] [-n=<n>] [-d=<bp>]
-  clusterscan.py clustermean FEATURES ANNOTATION [-o PATH] [-a NAME] [-c LIST] [--info FILE] [--singletons] [-n=<n>] [-w=<bp>] [-s=<bp>] [-k=<n>] [-e=<n>]
+  clusterscan.py index FEATURES ANNOTATION -o PATH [--chunksize=<n>]
+  clusterscan.py clusterdist (FEATURES ANNOTATION | --db PATH) [-o PATH] [--format NAME] [-a NAME] [-c LIST] [--info FILE] [--singletons] [--no-plot] [--plotter NAME] [--engine NAME] [-t=<n>] [--chunksize=<n>] [--previous PATH] [--cache-dir PATH] [--cache-size=<MB>] [--profile] [--tempdir PATH] [--permutations=<n>] [--random-seed=<n>] [-n=<n>] [-d=<bp>]
+  clusterscan.py clustermean (FEATURES ANNOTATION | --db PATH) [-o PATH] [--format NAME] [-a NAME] [-c LIST] [--info FILE] [--singletons] [--no-plot] [--plotter NAME] [--engine NAME] [-t=<n>] [--chunksize=<n>] [--previous PATH] [--cache-dir PATH] [--cache-size=<MB>] [--profile] [--tempdir PATH] [--permutations=<n>] [--random-seed=<n>] [-n=<n>] [-w=<bp>] [-s=<bp>] [-k=<n>] [-e=<n>]
+  clusterscan.py sweep (clusterdist | clustermean) (FEATURES ANNOTATION | --db PATH) [-o PATH] [--format NAME] [-a NAME] [-c LIST] [--info FILE] [--engine NAME] [-t=<n>] [--chunksize=<n>] [--tempdir PATH] [-n=<n>] [-d=<bp>] [-w=<bp>] [-s=<bp>] [-k=<n>] [-e=<n>]
+  clusterscan.py batch (clusterdist | clustermean) MANIFEST [-o PATH] [--format NAME] [--info FILE] [--singletons] [--no-plot] [--plotter NAME] [--engine NAME] [-t=<n>] [--tempdir PATH] [-n=<n>] [-d=<bp>] [-w=<bp>] [-s=<bp>] [-k=<n>] [-e=<n>]
   clusterscan.py (-h | --help)
   clusterscan.py --version
 
@@ -42,31 +51,50 @@ Options:
                                     Useful when you need to perform the analysis only for specific categories in the ANNOTATION file.
   --info FILE                       Specify optional file to describe categories.
   --singletons                      Identify singletons after clusters and bystanders annotation.
+  --no-plot                         Don't plot the distribution of features in clusters.
+  --plotter NAME                    Plotting library used to draw the distribution, ggplot2 (from R) or matplotlib [default: ggplot2].
+                                    matplotlib is used when R or ggplot2 are not available.
+  --engine NAME                     Interval engine used to compute clusters, bedtools or numpy [default: bedtools].
+  -t, --threads=<n>                 Number of processes used to scan the categories [default: 1].
+  --chunksize=<n>                   Read FEATURES and ANNOTATION <n> lines at a time with compact types, to bound memory usage.
+  --db PATH                         Read features and categories from an index made by the index command, instead of FEATURES and ANNOTATION.
+  --previous PATH                   Keep the clusters of each category in PATH; categories whose features are unchanged since the last run
+                                    with the same PATH and parameters are not scanned again.
+  --cache-dir PATH                  Keep the clusters of each category in PATH, keyed by its features and the parameters, and reuse them
+                                    whenever the same features are scanned again with the same parameters.
+  --cache-size=<MB>                 Size of the cache, least recently used clusters are evicted beyond it [default: 1024].
+  --profile                         Write the wall time, CPU time, peak memory and bedtools calls of each stage, and the slowest
+                                    categories, to a JSON report next to the outputs.
+  --tempdir PATH                    Directory of the temporary files of bedtools (e.g. on a local disk or tmpfs) instead of the system one.
+  --permutations=<n>                Shuffle the categories among the features <n> times, adding to the summary the empirical p-value
+                                    of the number of features in clusters of each category and its FDR [default: 0].
+  --random-seed=<n>                 Seed of the shuffles, to repeat them.
+  --format NAME                     Format of the output tables: tsv, bgzip (compressed and indexed with tabix, needs pysam),
+                                    parquet or feather (need pyarrow) [default: tsv].
   --version                         Show program version.
 """
 
 import time
 import os
 import warnings
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 import pybedtools
 from docopt import docopt
-from rpy2 import robjects
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.packages import importr
 
 from algos import *
-
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import rpy2.robjects.lib.ggplot2 as ggplot2
+from loader import *
+from profiling import Profiler, temp_peak
 
 start_time = time.time()
 
 
 def input_tester(file_path):
-    """Check for the presence of input files."""
+    """Check for the presence of input files (- is the standard input)."""
+    if file_path == '-':
+        return
     try:
         open(file_path)
     except IOError:
@@ -85,6 +113,14 @@ def options_tester(option, n, string):
 
 def rpy2_plotter(anno, clusters, name):
     """Plot genes distribution in clusters using ggplot2 from R."""
+    # R is started by the first import of rpy2
+    from rpy2 import robjects
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.packages import importr
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        import rpy2.robjects.lib.ggplot2 as ggplot2
+
     pandas2ri.activate()
     grdevices = importr('grDevices')
     rprint = robjects.globalenv.get("print")
@@ -102,130 +138,229 @@ def rpy2_plotter(anno, clusters, name):
     grdevices.dev_off()
 
 
-def main():
-    # test for input files availability
-    input_tester(arguments['FEATURES'])
-    input_tester(arguments['ANNOTATION'])
+def matplotlib_plotter(anno, clusters, name):
+    """Plot genes distribution in clusters using matplotlib, as rpy2_plotter does."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-    if arguments['--info'] is None:
-        pass
-    else:
-        input_tester(arguments['--info'])
+    anno = anno.sort_values(by="n_ft", ascending=False)
+    anno = anno.head(n=10)
+    # facets are sorted by category as in ggplot2
+    category = sorted(anno["category"].tolist())
+    clusters = clusters[clusters["category"].isin(category)]
 
-    # clusters can't contain less than 2 features
-    error1 = "Minimum number of features per cluster must be a number higher than 1!"
-    options_tester(int(arguments['--nf']), 2, error1)
+    bins = np.arange(clusters["n_features"].min() - 0.5, clusters["n_features"].max() + 1.5)
+    fig, axes = plt.subplots(-(-len(category) // 5), 5, sharex=True, sharey=True, squeeze=False,
+                             figsize=(11.692, 8.267))
+    for ax, cat in zip(axes.flat, category):
+        ax.hist(clusters["n_features"][clusters["category"] == cat].values, bins=bins, color='0.35')
+        ax.set_title(cat, fontsize=9)
+    for ax in axes.flat[len(category):]:
+        ax.set_visible(False)
+
+    fig.suptitle("Clusters distribution")
+    fig.text(0.5, 0.02, "Number of Features", ha='center')
+    fig.text(0.02, 0.5, "Number of Clusters", va='center', rotation='vertical')
+    fig.savefig(name, format='pdf')
+    plt.close(fig)
+
+
+def plotter(anno, clusters, name, backend):
+    """Plot genes distribution in clusters, with matplotlib if R can't be used."""
+    if backend == 'ggplot2':
+        try:
+            return rpy2_plotter(anno, clusters, name)
+        except (ImportError, RuntimeError) as e:
+            print "Unable to plot with ggplot2 (%s), matplotlib is used instead." % (e)
 
-    # window size can't be lower than sliding size
-    error2 = "Sliding size can't be higher than window size!"
-    options_tester(int(arguments['--window']), int(arguments['--slide']), error2)
+    try:
+        matplotlib_plotter(anno, clusters, name)
+    except ImportError:
+        print "Neither ggplot2 nor matplotlib are available, the distribution is not plotted."
 
-    # window size can't be lower than sliding size
-    error3 = "Seed or extension can't be a number lower than 1!"
-    options_tester(int(arguments['--seed']), 1, error3)
-    options_tester(int(arguments['--extension']), 1, error3)
-
-    # build database
-    feat = pd.read_table(arguments['FEATURES'], header=None, usecols=range(6), dtype={0: str})
-    anno = pd.read_table(arguments['ANNOTATION'], header=None)
-
-    feat.columns = ['chr', 'start', 'end', 'name', 'score', 'strand']
-    anno.columns = ['name', "category"]
-    # anno["category"] = anno["category"].fillna("Unknown")
-    n = list(feat.name.unique())
-
-    # pdtable stores genes annotation and corresponding categories
-    pdtable = pd.merge(feat, anno, on='name', how='outer')
-    pdtable["category"] = pdtable["category"].fillna("Unknown")
-    pdtable = pdtable[pd.notnull(pdtable["category"])]
-    pdtable = pdtable[pd.notnull(pdtable['chr'])]
-    pdtable[['start', 'end']] = pdtable[['start', 'end']].astype(int)
-    pdtable = pdtable.drop_duplicates(['name', "category"])
-    # movq print str(pdtable)
-    all_features = pdtable
-    pdtable = pdtable[pdtable["category"] != "Unknown"]
 
-    # list unique categories
-    if arguments['--category'] is None:
-        l = list(pdtable.category.unique())
-    else:
-        l = arguments['--category'].split(',')
-    # test the argument
-    if set(l) <= set(list(pdtable.category.unique())):
-        pass
-    else:
-        raise SystemExit('Some categories passed through the -c parameter are not present in the input files. Please, check your list and run the analysis again.')
+def table_writer(tables, file_name, fmt='tsv'):
+    """Write tables to a tsv file as they come and return the number of rows.
 
-    # inizialize empty table to be filled with clusters
-    table = pd.DataFrame()
+    The file is created only when the first table arrives. Other formats (see
+    frame_writer) are written at once, as feature tables.
+    """
+    if fmt != 'tsv':
+        df = collect(tables)
+        if not df.empty:
+            frame_writer(df, file_name, fmt, 0)
+        return len(df)
 
-    # choose the algorithm
-    if arguments['clusterdist'] is True:
-        print "ClusterScan is running with clusterdist..."
+    rows = 0
+    out = None
+    try:
+        for df in tables:
+            if out is None:
+                out = open(file_name, 'w')
+                df.to_csv(out, sep='\t', header=True, index=False)
+            else:
+                df.to_csv(out, sep='\t', header=False, index=False)
+            rows += len(df)
+    finally:
+        if out is not None:
+            out.close()
+    return rows
 
-        # movq: arguments should be changed
-        table = do_clusterdist(l,pdtable, table, arguments)
-    else:
-        print "ClusterScan is running with clustermean..."
 
-        table = do_clustermean(l, pdtable, table, arguments)
+def singletons_formatter(singletons):
+    """Name the columns of a singletons table as in the output file."""
+    singletons.columns = ["chr", "start", "end", "name", "score",
+                          "strand", "category"]
+    singletons = singletons.drop('score', axis=1)
+    singletons["start"] += 1
+    return singletons
 
-    if table.empty:
-        print "ClusterScan didn't found any cluster!"
-        exit()
+
+def output_names(output, analysis, fmt='tsv'):
+    """Assign the output file names, prefixed by the analysis name if any.
+
+    Tables and the bed file get the extension of fmt (see frame_writer).
+    """
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    if analysis is None:
+        prefix = ''
     else:
-        pass
+        prefix = analysis + '_'
+
+    names = {}
+    for key, suffix in [('features', 'features.tsv'), ('bystanders', 'bystanders.tsv'),
+                        ('clusters', 'clusters.tsv'), ('summary', 'summary.tsv'),
+                        ('bed', 'clusters.bed'), ('plot', 'distribution.pdf'),
+                        ('singletons', 'singletons.tsv'), ('profile', 'profile.json')]:
+        if fmt == 'bgzip' and suffix.endswith(('.tsv', '.bed')):
+            suffix += '.gz'
+        elif fmt in ['parquet', 'feather'] and suffix.endswith('.tsv'):
+            suffix = suffix[:-3] + fmt
+        names[key] = os.path.join(output, prefix + suffix)
+    return names
+
+
+FORMATS = {'tsv': None, 'bgzip': 'pysam', 'parquet': 'pyarrow', 'feather': 'pyarrow'}
+
+
+def format_tester(fmt):
+    """Check that the library needed to write fmt is available."""
+    if fmt not in FORMATS:
+        raise SystemExit('Unknown format %s, please choose among %s.' % (fmt, ', '.join(sorted(FORMATS))))
+    if FORMATS[fmt] is not None:
+        try:
+            __import__(FORMATS[fmt])
+        except ImportError:
+            raise SystemExit('%s is needed to write %s files, please install it.' % (FORMATS[fmt], fmt))
+
+
+def frame_writer(df, file_name, fmt='tsv', seq_col=None):
+    """Write a table as tsv, parquet, feather or bgzip compressed tsv.
+
+    With bgzip, tables with the chromosome, start and end in the columns
+    seq_col, seq_col + 1 and seq_col + 2 are sorted by position and indexed
+    with tabix (file_name + '.tbi').
+    """
+    if fmt == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(df, preserve_index=False), file_name)
+    elif fmt == 'feather':
+        import pyarrow.feather
+        pyarrow.feather.write_feather(df.reset_index(drop=True), file_name)
+    elif fmt == 'bgzip':
+        import pysam
+        if seq_col is not None:
+            # tabix needs rows sorted by chromosome and start, the header is skipped
+            chr, start = df.columns[seq_col], df.columns[seq_col + 1]
+            df = df.sort_values([chr, start])
+        # compressed in a single pass, without a plain copy on disk
+        bgzf = pysam.BGZFile(file_name, 'wb')
+        try:
+            df.to_csv(bgzf, sep='\t', header=True, index=False)
+        finally:
+            bgzf.close()
+        if seq_col is not None:
+            pysam.tabix_index(file_name, seq_col=seq_col, start_col=seq_col + 1, end_col=seq_col + 2,
+                              line_skip=1, force=True)
+    else:
+        df.to_csv(file_name, sep='\t', header=True, index=False)
+
+
+def info_reader(file_path):
+    """Read the optional category descriptions."""
+    desc = pd.read_table(file_path, header=None)
+    desc.columns = ["category", "description"]
+    return desc
 
+
+def cluster_annotator(table, all_features, nf, desc=None, engine='bedtools', singletons=None):
+    """Number the clusters and find their features and bystanders.
+
+    table is the raw cluster table joined from the do_* functions. Returns the
+    clusters, their bed version, the features, the bystanders and the summary,
+    formatted as they are written in the output files. With the numpy engine
+    the singletons of the categories listed in singletons can be found in the
+    same pass and are returned last (None if they still have to be searched
+    with do_singletons).
+    """
     # generate cluster table and filter it
     table.columns = ["chr", "start", "end", "n_features", "category"]
     table = table.sort_values(["category", "chr"], ascending=[True, True])
-    table = table[table["n_features"] >= int(arguments['--nf'])]
+    table = table[table["n_features"] >= nf]
     table = table.sort_values(by=["category"], ascending=[True])
     # table["cluster_id"] = range(1, len(table) + 1)
     table["cluster_id"] = ["C"+str(i) for i in range(1, len(table) + 1)]
-    # get the total number of clusters
-    c = table.shape[0]
 
     # generate output of clusters in BED format
     bedTbl = table.copy()
     bedTbl["strand"] = "+"
     bedTbl = bedTbl[[0, 1, 2, 5, 3, 6, 4]]
-    bed = pybedtools.BedTool().from_dataframe(bedTbl).sort()
-
-    # generate table of features by intersect feature with clusters
-    all_features_bed = pybedtools.BedTool().from_dataframe(all_features)
-    clusters = pybedtools.BedTool().from_dataframe(table)
-    features = all_features_bed.intersect(clusters, wb=True)
-    features = pd.read_table(features.fn, header=None, dtype={0: str, 7: str})
-    cl_features = features[features[6] == features[11]]
-    cl_features = cl_features[[0, 1, 2, 3, 4, 5, 12, 11]]
-    cl_features.columns = ["chr", "start", "end", "name", "score",
-                           "strand", "cluster_id", "category"]
-    cl_features.drop('score', axis=1, inplace=True)
-    # generate table of bystanders
-    bystanders = features[features[6] != features[11]]
-
-    # comment if you want to search for bystanders using only 1 category
-    #if len(l) == 1:
-    #    bystanders = pd.DataFrame()
-    #else:
-    #    pass
+
+    if engine == 'numpy':
+        # sweep features and clusters in memory
+        cl_features, bystanders, st = feature_assigner(all_features, table, singletons)
+    else:
+        # generate table of features by intersect feature with clusters
+        all_features_bed = pybedtools.BedTool().from_dataframe(all_features)
+        clusters = pybedtools.BedTool().from_dataframe(table)
+        features = all_features_bed.intersect(clusters, wb=True)
+        features = pd.read_table(features.fn, header=None, dtype={0: str, 7: str})
+        st = None
+        cl_features = features[features[6] == features[11]]
+        cl_features = cl_features[[0, 1, 2, 3, 4, 5, 12, 11]]
+        cl_features.columns = ["chr", "start", "end", "name", "score",
+                               "strand", "cluster_id", "category"]
+        cl_features.drop('score', axis=1, inplace=True)
+        # generate table of bystanders
+        bystanders = features[features[6] != features[11]]
+
+        # comment if you want to search for bystanders using only 1 category
+        #if len(l) == 1:
+        #    bystanders = pd.DataFrame()
+        #else:
+        #    pass
+
+        if not bystanders.empty:
+            bystanders = bystanders[[0, 1, 2, 3, 4, 5, 12, 11]]
+            bystanders.columns = ["chr", "start", "end", "name", "score",
+                                  "strand", "cluster_id", "category"]
+            # prevent bystanders with 2+ different categories to be counted twice
+            bystanders = bystanders.drop_duplicates(['name', "cluster_id"])
+            # prevent features with 2+ different categories to be bystanders in theyr clusters
+            bs_merge = pd.merge(bystanders, cl_features, how='outer', indicator=True)
+            bystanders = bs_merge.ix[bs_merge._merge == 'left_only']
+            #bystanders = bystanders.drop(bystanders.columns[8], axis=1)
+            bystanders = bystanders.drop(bystanders.columns[[4, 8]], axis=1)
 
     # control for bystander = 0 (when program run with 1 category)
     if bystanders.empty:
         table = table[[5, 4, 0, 1, 2, 3]]
         table["n_bystanders"] = 0
     else:
-        bystanders = bystanders[[0, 1, 2, 3, 4, 5, 12, 11]]
-        bystanders.columns = ["chr", "start", "end", "name", "score",
-                              "strand", "cluster_id", "category"]
-        # prevent bystanders with 2+ different categories to be counted twice
-        bystanders = bystanders.drop_duplicates(['name', "cluster_id"])
-        # prevent features with 2+ different categories to be bystanders in theyr clusters
-        bs_merge = pd.merge(bystanders, cl_features, how='outer', indicator=True)
-        bystanders = bs_merge.ix[bs_merge._merge == 'left_only']
-        #bystanders = bystanders.drop(bystanders.columns[8], axis=1)
-        bystanders = bystanders.drop(bystanders.columns[[4, 8]], axis=1)
         # count bystanders number
         bs_count = bystanders.groupby("cluster_id").count().reset_index()
         bs_count = bs_count[[0, 1]]
@@ -253,32 +388,11 @@ def main():
     min_ft_bs = summary.groupby("category").min().reset_index()
     min_ft_bs.columns = ["category", "min_ft", "min_bs"]
     # add category description if an info file is provided
-    if arguments['--info'] is None:
+    if desc is None:
         summary = n_clusters.merge(n_ft_bs, on="category").merge(max_ft_bs, on="category").merge(min_ft_bs, on="category")
     else:
-        desc = pd.read_table(arguments['--info'], header=None)
-        desc.columns = ["category", "description"]
         summary = n_clusters.merge(n_ft_bs, on="category").merge(max_ft_bs, on="category").merge(min_ft_bs, on="category").merge(desc, on="category")
 
-    # assign file names and save tables as result
-    if not os.path.exists(arguments['--output']):
-        os.makedirs(arguments['--output'])
-
-    if arguments['--analysis'] is None:
-        feat_name = os.path.join(arguments['--output'], 'features.tsv')
-        byst_name = os.path.join(arguments['--output'], 'bystanders.tsv')
-        clus_name = os.path.join(arguments['--output'], 'clusters.tsv')
-        summ_name = os.path.join(arguments['--output'], 'summary.tsv')
-        bed_name = os.path.join(arguments['--output'], 'clusters.bed')
-        plot_name = os.path.join(arguments['--output'], 'distribution.pdf')
-    else:
-        feat_name = os.path.join(arguments['--output'], arguments['--analysis']+'_features.tsv')
-        byst_name = os.path.join(arguments['--output'], arguments['--analysis']+'_bystanders.tsv')
-        clus_name = os.path.join(arguments['--output'], arguments['--analysis']+'_clusters.tsv')
-        summ_name = os.path.join(arguments['--output'], arguments['--analysis']+'_summary.tsv')
-        bed_name = os.path.join(arguments['--output'], arguments['--analysis']+'_clusters.bed')
-        plot_name = os.path.join(arguments['--output'], arguments['--analysis']+'_distribution.pdf')
-
     cl_features["start"] += 1
     table["start"] += 1
 
@@ -288,42 +402,537 @@ def main():
         summary["max_bs"] = 'NA'
         summary["min_bs"] = 'NA'
 
-    cl_features.to_csv(feat_name, sep='\t', header=True, index=False)
-    bystanders.to_csv(byst_name, sep='\t', header=True, index=False)
-    table.to_csv(clus_name, sep='\t', header=True, index=False)
-    summary.to_csv(summ_name, sep='\t', header=True, index=False)
+    return table, bedTbl, cl_features, bystanders, summary, st
+
+
+def select_categories(pdtable, categories=None):
+    """The categories of pdtable to scan: all of them, or those listed if all are present."""
+    if categories is None:
+        return list(pdtable.category.unique())
+    if set(categories) <= set(pdtable.category.unique()):
+        return list(categories)
+    raise ValueError('Some categories are not present in the annotation.')
+
+
+def scan_results(method, l, pdtable, all_features, table, sargs, nf, desc=None, singletons=False, threads=1,
+                 permutations=0, random_seed=None, profiler=None):
+    """Annotate the raw clusters of the categories l and return the result tables.
+
+    table holds the clusters found by find_clusters (or saved by a previous
+    run), the other arguments are those of scan; the stages are measured by
+    profiler if given. Returns a dictionary of the clusters, bed, features,
+    bystanders and summary tables, and the singletons as an iterator over the
+    tables of each category, found as it is read (None unless asked).
+    """
+    if profiler is None:
+        profiler = Profiler(False)
+
+    # number clusters, annotate features and bystanders, summarize
+    with profiler.stage('annotate'):
+        tempfiles = len(pybedtools.BedTool.TEMPFILES)
+        # the raw table gives the observed counts of the permutations
+        results = cluster_annotator(table.copy(), all_features, nf, desc, sargs['--engine'], l if singletons else None)
+        release_tempfiles(tempfiles)
+    results = dict(zip(['clusters', 'bed', 'features', 'bystanders', 'summary', 'singletons'], results))
+
+    # compare the features in clusters of each category to shuffled categories
+    if permutations > 0:
+        with profiler.stage('permutations'):
+            pvalues = permutation_test(method, l, pdtable, table, sargs, nf, permutations, random_seed, threads)
+        results['summary'] = results['summary'].merge(pvalues, on='category', how='left')
+
+    # unless found with features and bystanders, singletons are searched
+    # category by category as they are read
+    if singletons:
+        if results['singletons'] is None:
+            tables = run_threads(threads, do_singletons, l, pdtable, results['bed'], sargs)
+        else:
+            tables = [results['singletons']]
+        results['singletons'] = (singletons_formatter(df) for df in tables if not df.empty)
+
+    return results
+
+
+def scan(features, annotation, method='dist', nf=2, dist=500000, window=500000, slide=250000, seed=3, extension=2,
+         categories=None, desc=None, singletons=False, engine='numpy', threads=1, permutations=0, random_seed=None):
+    """Search for clusters and return the result tables, without writing any file.
+
+    features and annotation are tables (or file names) as FEATURES and
+    ANNOTATION, method is dist (clusterdist) or mean (clustermean), the other
+    arguments are those of the command line (permutations adds p_value and
+    fdr columns to the summary). Returns a dictionary of the
+    clusters, bed, features, bystanders, summary and singletons tables, as
+    written in the output files; singletons is None unless asked, and all
+    tables are empty when no cluster is found.
+    """
+    if method not in ['dist', 'mean']:
+        raise ValueError('Unknown method %s, please choose between dist and mean.' % (method))
+    if engine not in ['bedtools', 'numpy']:
+        raise ValueError('Unknown engine %s, please choose between bedtools and numpy.' % (engine))
+    options_tester(nf, 2, "Minimum number of features per cluster must be a number higher than 1!")
+    options_tester(window, slide, "Sliding size can't be higher than window size!")
+    options_tester(min(seed, extension), 1, "Seed or extension can't be a number lower than 1!")
+
+    if isinstance(features, pd.DataFrame) and isinstance(annotation, pd.DataFrame):
+        pdtable, n = join_table(features, annotation)
+    else:
+        pdtable, n = build_table(features, annotation)
+    all_features = pdtable
+    pdtable = pdtable[pdtable["category"] != "Unknown"]
+    l = select_categories(pdtable, categories)
+
+    sargs = {'--engine': engine, '--dist': str(dist), '--window': str(window), '--slide': str(slide),
+             '--seed': str(seed), '--extension': str(extension)}
+    table = find_clusters(method, l, pdtable, sargs, threads)
+
+    if table.empty or not (table[3] >= nf).any():
+        names = ['clusters', 'bed', 'features', 'bystanders', 'summary', 'singletons']
+        return dict((name, pd.DataFrame()) for name in names)
+
+    results = scan_results(method, l, pdtable, all_features, table, sargs, nf, desc, singletons, threads,
+                           permutations, random_seed)
+    if singletons:
+        results['singletons'] = collect(results['singletons'])
+
+    return results
+
+
+def results_writer(names, table, bedTbl, cl_features, bystanders, summary, track, fmt='tsv'):
+    """Save the tables made by cluster_annotator, in the format fmt (see frame_writer)."""
+    frame_writer(cl_features, names['features'], fmt, 0)
+    frame_writer(bystanders, names['bystanders'], fmt, 0)
+    frame_writer(table, names['clusters'], fmt, 2)
+    frame_writer(summary, names['summary'], fmt)
+
+    trackline = 'track name="%s" description="chr start end cluster_id n_features strand category"' % (track)
+    if fmt == 'tsv':
+        bed = pybedtools.BedTool().from_dataframe(bedTbl).sort()
+        bed.saveas(names['bed'], trackline=trackline)
+    else:
+        # sorted as bedtools does, without calling it
+        bedTbl = bedTbl.sort_values([bedTbl.columns[0], bedTbl.columns[1]])
+        if fmt == 'bgzip':
+            # compressed in a single pass, as frame_writer does
+            import pysam
+            bed = pysam.BGZFile(names['bed'], 'wb')
+        else:
+            bed = open(names['bed'], 'w')
+        try:
+            bed.write(trackline + '\n')
+            bedTbl.to_csv(bed, sep='\t', header=False, index=False)
+        finally:
+            bed.close()
+        if fmt == 'bgzip':
+            pysam.tabix_index(names['bed'], seq_col=0, start_col=1, end_col=2, zerobased=True, line_skip=1, force=True)
+
+
+def run_params(pdtable):
+    """Describe the parameters the raw clusters of every category depend on."""
+    if arguments['clusterdist'] is True:
+        return 'clusterdist dist=%s engine=%s' % (int(arguments['--dist']), arguments['--engine'])
+
+    # windows span the chromosomes up to their last feature, whatever its category
+    chr_end = pdtable.groupby('chr').end.max()
+    return 'clustermean window=%s slide=%s seed=%s extension=%s engine=%s %s' % (
+        int(arguments['--window']), int(arguments['--slide']), int(arguments['--seed']),
+        int(arguments['--extension']), arguments['--engine'],
+        ' '.join(['%s:%s' % (chr, end) for chr, end in chr_end.iteritems()]))
+
+
+def values_parser(option):
+    """List the integer values of an option (comma separated with sweep)."""
+    values = [int(value) for value in arguments[option].split(',')]
+    if len(values) > 1 and arguments['sweep'] is False:
+        raise SystemExit('Lists of values for %s are only allowed with sweep.' % (option))
+    return values
+
+
+def sweep(l, pdtable, all_features, desc, threads):
+    """Scan the categories with every combination of the listed parameters.
+
+    Sorted features and window counts are computed once and shared by the
+    combinations using them. One result set is written for each combination,
+    and one table joins all the summaries.
+    """
+    nfs = values_parser('--nf')
+    runs = []
+
+    if arguments['clusterdist'] is True:
+        print "ClusterScan is sweeping clusterdist..."
+
+        if arguments['--engine'] == 'numpy':
+            features = sort_features(l, pdtable)
+        for dist in values_parser('--dist'):
+            sargs = dict(arguments, **{'--dist': str(dist)})
+            if arguments['--engine'] == 'numpy':
+                tables = run_threads(threads, do_clusterdist_numpy, l, pdtable, sargs, features)
+            else:
+                tables = run_threads(threads, do_clusterdist, l, pdtable, sargs)
+            runs.append(([('dist', dist)], collect(tables)))
+    else:
+        print "ClusterScan is sweeping clustermean..."
+
+        for window in values_parser('--window'):
+            for slide in values_parser('--slide'):
+                if slide > window:
+                    continue
+                sargs = dict(arguments, **{'--window': str(window), '--slide': str(slide)})
+                windows = mean_windows(pdtable, sargs)
+                counts = window_counts(windows, l, pdtable)
+
+                for seed in values_parser('--seed'):
+                    for extension in values_parser('--extension'):
+                        sargs = dict(sargs, **{'--seed': str(seed), '--extension': str(extension)})
+                        tables = run_threads(threads, do_clustermean, l, pdtable, sargs, windows, counts)
+                        params = [('window', window), ('slide', slide), ('seed', seed), ('extension', extension)]
+                        runs.append((params, collect(tables)))
+
+    summaries = []
+    for params, raw in runs:
+        for nf in nfs:
+            tag = '_'.join(['%s%s' % (key, value) for key, value in params + [('nf', nf)]])
+            if raw.empty or not (raw[3] >= nf).any():
+                print "ClusterScan didn't found any cluster with %s!" % (tag)
+                continue
+
+            if arguments['--analysis'] is None:
+                names = output_names(arguments['--output'], tag, arguments['--format'])
+            else:
+                names = output_names(arguments['--output'], arguments['--analysis'] + '_' + tag, arguments['--format'])
+
+            tempfiles = len(pybedtools.BedTool.TEMPFILES)
+            table, bedTbl, cl_features, bystanders, summary, st = cluster_annotator(raw.copy(), all_features, nf, desc, arguments['--engine'])
+            results_writer(names, table, bedTbl, cl_features, bystanders, summary, tag, arguments['--format'])
+            release_tempfiles(tempfiles)
+            print '%s\t%s' % ("Total number of clusters found with %s:" % (tag), table.shape[0])
+
+            for key, value in reversed(params + [('nf', nf)]):
+                summary.insert(0, key, value)
+            summaries.append(summary)
 
     if arguments['--analysis'] is None:
-        bed.saveas(bed_name, trackline='track name="%s" description="chr start end cluster_id n_features strand category"' % (arguments['FEATURES']))
+        summ_name = os.path.join(arguments['--output'], 'sweep_summary.tsv')
+    else:
+        summ_name = os.path.join(arguments['--output'], arguments['--analysis'] + '_sweep_summary.tsv')
+    collect(summaries).to_csv(summ_name, sep='\t', header=True, index=False)
+
+
+def manifest_reader(file_path):
+    """Read the FEATURES, ANNOTATION and analysis name of each row of a batch manifest.
+
+    Empty rows and rows starting with # are skipped; without a name the
+    analysis is named after FEATURES.
+    """
+    jobs = []
+    for line in open(file_path):
+        fields = line.rstrip('\r\n').split('\t')
+        if not line.strip() or line.startswith('#'):
+            continue
+        if len(fields) == 2:
+            fields.append(os.path.splitext(os.path.basename(fields[0]))[0])
+        if len(fields) != 3:
+            raise SystemExit('Unable to read %s, manifest rows need FEATURES, ANNOTATION and an optional analysis name!' % (file_path.split('/')[-1]))
+        input_tester(fields[0])
+        input_tester(fields[1])
+        jobs.append(tuple(fields))
+
+    names = [name for features, annotation, name in jobs]
+    if len(set(names)) < len(names):
+        raise SystemExit('Analysis names in %s must be unique!' % (file_path.split('/')[-1]))
+    return jobs
+
+
+_batch = {}
+
+
+def batch_analysis(job):
+    """Analyze one row of a batch manifest and write its results.
+
+    Returns the analysis name with its number of clusters, or with the error
+    which stopped it.
+    """
+    features, annotation, name = job
+    tempfiles = len(pybedtools.BedTool.TEMPFILES)
+    try:
+        results = scan(features, annotation, 'dist' if arguments['clusterdist'] is True else 'mean',
+                       int(arguments['--nf']), int(arguments['--dist']), int(arguments['--window']),
+                       int(arguments['--slide']), int(arguments['--seed']), int(arguments['--extension']),
+                       desc=_batch['desc'], singletons=arguments['--singletons'], engine=arguments['--engine'])
+        if results['clusters'].empty:
+            return name, 0, None
+
+        names = output_names(arguments['--output'], name, arguments['--format'])
+        results_writer(names, results['clusters'], results['bed'], results['features'],
+                       results['bystanders'], results['summary'], name, arguments['--format'])
+        if arguments['--no-plot'] is False:
+            plotter(results['summary'], results['clusters'], names['plot'], arguments['--plotter'])
+        if arguments['--singletons'] is True:
+            table_writer([df for df in [results['singletons']] if not df.empty], names['singletons'], arguments['--format'])
+    except Exception as e:
+        return name, None, str(e)
+    finally:
+        # pool processes never reach the pybedtools cleanup at exit
+        release_tempfiles(tempfiles)
+
+    return name, results['clusters'].shape[0], None
+
+
+def _init_batch(desc):
+    """Keep the category descriptions shared by the analyses of a batch."""
+    _batch['desc'] = desc
+
+
+def batch(threads):
+    """Analyze every row of the manifest, in a pool of processes when threads > 1.
+
+    Modules (and R, if used) are loaded once per process and the category
+    descriptions are read once for all the analyses. Results are written as
+    each analysis is done.
+    """
+    jobs = manifest_reader(arguments['MANIFEST'])
+    desc = None if arguments['--info'] is None else info_reader(arguments['--info'])
+
+    if threads <= 1 or len(jobs) <= 1:
+        _init_batch(desc)
+        done = (batch_analysis(job) for job in jobs)
+        pool = None
+    else:
+        pool = Pool(min(threads, len(jobs)), _init_batch, (desc,))
+        done = pool.imap_unordered(batch_analysis, jobs)
+
+    failed = 0
+    try:
+        for name, c, error in done:
+            if error is not None:
+                failed += 1
+                print "%s failed: %s" % (name, error)
+            else:
+                print '%s\t%s' % ("Total number of clusters found for %s:" % (name), c)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print '\n%s\t%s' % ("Total number of analyses done:", len(jobs) - failed)
+    if failed:
+        raise SystemExit('%s of %s analyses failed!' % (failed, len(jobs)))
+
+
+def main():
+    # test for input files availability
+    if arguments['batch'] is True:
+        input_tester(arguments['MANIFEST'])
+    elif arguments['--db'] is None:
+        input_tester(arguments['FEATURES'])
+        input_tester(arguments['ANNOTATION'])
+        if arguments['FEATURES'] == arguments['ANNOTATION'] == '-':
+            raise SystemExit('Only one of FEATURES and ANNOTATION can be read from the standard input!')
+    elif not os.path.isdir(arguments['--db']):
+        raise SystemExit('Unable to open %s, index does not exist!' % (arguments['--db'].rstrip('/').split('/')[-1]))
+
+    if arguments['--info'] is None:
+        pass
     else:
-        bed.saveas(bed_name, trackline='track name="%s" description="chr start end cluster_id n_features strand category"' % (arguments['--analysis']))
+        input_tester(arguments['--info'])
+
+    # clusters can't contain less than 2 features
+    error1 = "Minimum number of features per cluster must be a number higher than 1!"
+    for nf in values_parser('--nf'):
+        options_tester(nf, 2, error1)
+
+    # window size can't be lower than sliding size
+    error2 = "Sliding size can't be higher than window size!"
+    options_tester(max(values_parser('--window')), min(values_parser('--slide')), error2)
+
+    # window size can't be lower than sliding size
+    error3 = "Seed or extension can't be a number lower than 1!"
+    for k in values_parser('--seed') + values_parser('--extension'):
+        options_tester(k, 1, error3)
+
+    # compressed and columnar formats need optional libraries
+    format_tester(arguments['--format'])
+
+    # permutations can't be negative
+    error7 = "Number of permutations can't be a number lower than 0!"
+    options_tester(int(arguments['--permutations']), 0, error7)
+
+    # distances must be numbers too
+    values_parser('--dist')
+
+    # at least one process is needed
+    error4 = "Number of threads can't be a number lower than 1!"
+    options_tester(int(arguments['--threads']), 1, error4)
+    threads = int(arguments['--threads'])
+
+    # only two interval engines are available
+    if arguments['--engine'] not in ['bedtools', 'numpy']:
+        raise SystemExit('Unknown engine %s, please choose between bedtools and numpy.' % (arguments['--engine']))
+
+    # plots are drawn by R or by python
+    if arguments['--plotter'] not in ['ggplot2', 'matplotlib']:
+        raise SystemExit('Unknown plotter %s, please choose between ggplot2 and matplotlib.' % (arguments['--plotter']))
+
+    # time, memory and bedtools calls of each stage
+    profiler = Profiler(arguments['--profile'])
+
+    # temporary files go to a local or in-memory disk if asked
+    if arguments['--tempdir'] is not None:
+        if not os.path.exists(arguments['--tempdir']):
+            os.makedirs(arguments['--tempdir'])
+        pybedtools.set_tempdir(arguments['--tempdir'])
+
+    # analyze every row of the manifest in this process
+    if arguments['batch'] is True:
+        batch(threads)
+        return
+
+    # build database, pdtable stores genes annotation and corresponding categories
+    with profiler.stage('load'):
+        if arguments['--db'] is not None:
+            pdtable, n = read_index(arguments['--db'])
+        elif arguments['--chunksize'] is None:
+            pdtable, n = build_table(arguments['FEATURES'], arguments['ANNOTATION'])
+        else:
+            error5 = "Chunk size can't be a number lower than 1!"
+            options_tester(int(arguments['--chunksize']), 1, error5)
+            pdtable, n = build_table(arguments['FEATURES'], arguments['ANNOTATION'], int(arguments['--chunksize']))
+    # movq print str(pdtable)
+
+    # save the database to be reused by the next runs
+    if arguments['index'] is True:
+        write_index(pdtable, arguments['--output'])
+        print '\n%s\t%s' % ("Total number of unique features indexed:", n)
+        print '%s\t%s\n' % ("Total number of rows indexed:", len(pdtable))
+        return
+    all_features = pdtable
+    pdtable = pdtable[pdtable["category"] != "Unknown"]
+
+    # list unique categories, or test the argument
+    try:
+        l = select_categories(pdtable, None if arguments['--category'] is None else arguments['--category'].split(','))
+    except ValueError:
+        raise SystemExit('Some categories passed through the -c parameter are not present in the input files. Please, check your list and run the analysis again.')
+
+    if arguments['--info'] is None:
+        desc = None
+    else:
+        desc = info_reader(arguments['--info'])
+
+    # try every combination of parameters
+    if arguments['sweep'] is True:
+        sweep(l, pdtable, all_features, desc, threads)
+        return
+
+    # categories are known by the digest of their features and of the parameters
+    if arguments['--previous'] is not None or arguments['--cache-dir'] is not None:
+        digests = category_digests(pdtable, l, run_params(pdtable))
+
+    # only scan the categories changed since the previous run
+    if arguments['--previous'] is None:
+        todo = l
+    else:
+        saved, previous = read_state(arguments['--previous'])
+        # the state is saved as text, numeric categories are read back as strings
+        labels = dict((str(category), category) for category in pdtable.category.unique())
+        previous[4] = previous[4].map(lambda category: labels.get(category, category))
+        todo = [category for category in l if saved.get(str(category)) != digests[category]]
+        print "%s of %s categories changed since the previous run." % (len(todo), len(l))
+
+    # nor those found in the cache
+    if arguments['--cache-dir'] is None:
+        hits = {}
+    else:
+        error6 = "Cache size can't be a number lower than 0!"
+        options_tester(int(arguments['--cache-size']), 0, error6)
+        hits = cache_read(arguments['--cache-dir'], dict((category, digests[category]) for category in todo))
+        print "%s of %s categories found in the cache." % (len(hits), len(todo))
+    to_scan = [category for category in todo if category not in hits]
+
+    # choose the algorithm
+    if arguments['clusterdist'] is True:
+        print "ClusterScan is running with clusterdist..."
+        method = 'dist'
+    else:
+        print "ClusterScan is running with clustermean..."
+        method = 'mean'
+
+    with profiler.stage('clusters'):
+        table = find_clusters(method, to_scan, pdtable, arguments, threads)
+
+    if arguments['--cache-dir'] is not None:
+        cache_write(arguments['--cache-dir'], dict((category, digests[category]) for category in to_scan), table,
+                    int(arguments['--cache-size']) * 2 ** 20)
+
+    if arguments['--previous'] is not None or hits:
+        # add the saved clusters of unchanged and cached categories, in the order of l
+        kept = [previous[previous[4].isin(set(l) - set(todo))]] if arguments['--previous'] is not None else []
+        table = collect(kept + list(hits.values()) + [table])
+        if not table.empty:
+            rank = table[4].map(dict(zip(l, range(len(l)))))
+            table = table.iloc[rank.values.argsort(kind='mergesort')]
+
+    if arguments['--previous'] is not None:
+        # categories left out by -c keep their saved clusters
+        saved.update((str(category), digest) for category, digest in digests.items())
+        write_state(arguments['--previous'], saved,
+                    collect([previous[~previous[4].isin(l)], table]))
+
+    nf = int(arguments['--nf'])
+    if table.empty or not (table[3] >= nf).any():
+        print "ClusterScan didn't found any cluster!"
+        # the load and cluster stages are still worth a report
+        if arguments['--profile'] is True:
+            profiler.write(output_names(arguments['--output'], arguments['--analysis'], arguments['--format'])['profile'])
+        exit()
+    else:
+        pass
+
+    if int(arguments['--permutations']) > 0:
+        print "ClusterScan is shuffling categories %s times..." % (arguments['--permutations'])
+    seed = None if arguments['--random-seed'] is None else int(arguments['--random-seed'])
+    results = scan_results(method, l, pdtable, all_features, table, arguments, nf, desc, arguments['--singletons'],
+                           threads, int(arguments['--permutations']), seed, profiler)
+    table, summary = results['clusters'], results['summary']
+    # get the total number of clusters
+    c = table.shape[0]
+
+    # assign file names and save tables as result
+    names = output_names(arguments['--output'], arguments['--analysis'], arguments['--format'])
+
+    with profiler.stage('write'):
+        tempfiles = len(pybedtools.BedTool.TEMPFILES)
+        if arguments['--analysis'] is None and arguments['--db'] is not None:
+            track = arguments['--db']
+        elif arguments['--analysis'] is None:
+            track = arguments['FEATURES']
+        else:
+            track = arguments['--analysis']
+        results_writer(names, table, results['bed'], results['features'], results['bystanders'], summary, track,
+                       arguments['--format'])
+        release_tempfiles(tempfiles)
 
     # plot a duistribution for top 10 clusters (per n of features)
-    rpy2_plotter(summary, table, plot_name)
+    if arguments['--no-plot'] is False:
+        with profiler.stage('plot'):
+            plotter(summary, table, names['plot'], arguments['--plotter'])
 
     if arguments['--singletons'] is True:
         print "Singletons identification has been launched..."
-        singletons = pd.DataFrame()
-        singletons = do_singletons(l, pdtable, bedTbl, singletons, arguments)
-        if singletons.empty:
-            print "ClusterScan didn't found any singleton!"
-        else:
-            if arguments['--analysis'] is None:
-                st_name = os.path.join(arguments['--output'], 'singletons.tsv')
-            else:
-                st_name = os.path.join(arguments['--output'], arguments['--analysis']+'_singletons.tsv')
 
-            singletons.columns = ["chr", "start", "end", "name", "score",
-                              "strand", "category"]
-            singletons.drop('score', axis=1, inplace=True)
-            singletons["start"] += 1
-            singletons.to_csv(st_name, sep='\t', header=True, index=False)
+        # singletons are written as soon as each category is done
+        with profiler.stage('singletons'):
+            if table_writer(results['singletons'], names['singletons'], arguments['--format']) == 0:
+                print "ClusterScan didn't found any singleton!"
     else:
         pass
 
-    print '\n%s\t%s' % ("Total number of unique features scanned:", len(n))
+    print '\n%s\t%s' % ("Total number of unique features scanned:", n)
     print '%s\t%s' % ("Total number of unique categories scanned:", len(l))
-    print '%s\t%s\n' % ("Total number of clusters found:", c)
+    print '%s\t%s' % ("Total number of clusters found:", c)
+    print '%s\t%s\n' % ("Peak size of temporary files (MB):", round(temp_peak() / 2.0 ** 20, 1))
+
+    if arguments['--profile'] is True:
+        profiler.write(names['profile'])
 
 
 # program execution
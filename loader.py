@@ -0,0 +1,372 @@
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+TABLE_COLUMNS = ['chr', 'start', 'end', 'name', 'score', 'strand', 'category']
+
+
+class Levels(object):
+    """Dictionary encoding of a string column shared by all the chunks of a file."""
+
+    def __init__(self):
+        # the codes grow in place, so each chunk only costs its own length
+        self.codes = {}
+        self.values = []
+
+    def encode(self, values, grow=True):
+        """Integer codes of values, -1 for unseen values when grow is False."""
+        uniques = pd.unique(values)
+        if grow:
+            for value in uniques:
+                if value not in self.codes:
+                    self.codes[value] = len(self.values)
+                    self.values.append(value)
+
+        lookup = np.array([self.codes.get(value, -1) for value in uniques], dtype=np.int32)
+        return lookup[pd.Index(uniques).get_indexer(values)]
+
+    def decode(self, codes):
+        """Values of codes; equal values share the same string object."""
+        return np.array(self.values, dtype=object).take(codes)
+
+
+class GzipStream(object):
+    """Decompress a gzip or bgzip (many members) stream as it is read, without seeking."""
+
+    def __init__(self, raw, size=1 << 16):
+        self.raw = raw
+        self.size = size
+        self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            # the data after the end of a member start the next one
+            if self.inflate.unused_data:
+                data = self.inflate.unused_data
+                self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self.raw.read(self.size)
+                if not data:
+                    break
+            self.buffer += self.inflate.decompress(data)
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def input_source(file_path):
+    """Open file_path once for pandas to read it.
+
+    - stands for the standard input; gzip and bgzip inputs are recognized by
+    their magic number, whatever their extension, and decompressed while
+    they are read, so that pipes and process substitutions work as well.
+    """
+    if file_path == '-':
+        raw = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+    else:
+        raw = io.open(file_path, 'rb')
+
+    # peek does not consume the bytes, even on a pipe
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        return GzipStream(raw)
+    return raw
+
+
+def build_table(features, annotation, chunksize=None):
+    """Join FEATURES and ANNOTATION on the feature name.
+
+    Returns the table of features with their categories (Unknown for features
+    without annotation, one row per feature name and category) and the number
+    of unique feature names.
+    """
+    if chunksize is not None:
+        return chunked_table(features, annotation, chunksize)
+
+    with input_source(features) as source:
+        feat = pd.read_table(source, header=None, usecols=range(6), dtype={0: str})
+    with input_source(annotation) as source:
+        anno = pd.read_table(source, header=None)
+
+    return join_table(feat, anno)
+
+
+def join_table(feat, anno):
+    """Same as build_table, for FEATURES and ANNOTATION already read as tables."""
+    feat = feat.iloc[:, :6].copy()
+    anno = anno.iloc[:, :2].copy()
+    feat.columns = ['chr', 'start', 'end', 'name', 'score', 'strand']
+    anno.columns = ['name', "category"]
+    feat['chr'] = feat['chr'].astype(str)
+    # anno["category"] = anno["category"].fillna("Unknown")
+    n = len(feat.name.unique())
+
+    # pdtable stores genes annotation and corresponding categories
+    pdtable = pd.merge(feat, anno, on='name', how='outer')
+    pdtable["category"] = pdtable["category"].fillna("Unknown")
+    pdtable = pdtable[pd.notnull(pdtable["category"])]
+    pdtable = pdtable[pd.notnull(pdtable['chr'])]
+    pdtable[['start', 'end']] = pdtable[['start', 'end']].astype(int)
+    pdtable = pdtable.drop_duplicates(['name', "category"])
+
+    return pdtable, n
+
+
+def chunked_table(features, annotation, chunksize):
+    """Same as build_table, reading both files chunksize lines at a time.
+
+    Strings are dictionary encoded while reading, coordinates are stored as
+    int32 and the join is made on the integer codes of the feature names, so
+    that neither file is ever held in memory as a table of strings. Peak
+    memory is about 100 bytes for each (feature, category) row of the result
+    (48 bytes once loaded), plus one copy of each distinct string and one
+    chunk of text.
+    """
+    chroms, names, scores, strands, categories = Levels(), Levels(), Levels(), Levels(), Levels()
+    feat = dict((column, []) for column in TABLE_COLUMNS[:6])
+
+    with input_source(features) as source:
+        for chunk in pd.read_table(source, header=None, usecols=range(6), chunksize=chunksize,
+                                   dtype={0: str, 1: np.int32, 2: np.int32, 3: str, 4: str, 5: str}):
+            feat['chr'].append(chroms.encode(chunk[0].values))
+            feat['start'].append(chunk[1].values)
+            feat['end'].append(chunk[2].values)
+            feat['name'].append(names.encode(chunk[3].values))
+            feat['score'].append(scores.encode(chunk[4].values))
+            feat['strand'].append(strands.encode(chunk[5].values))
+    feat = dict((column, np.concatenate(feat[column])) for column in feat)
+
+    # names missing from FEATURES have no position and are left out at once
+    anno_name, anno_cat = [], []
+    with input_source(annotation) as source:
+        for chunk in pd.read_table(source, header=None, chunksize=chunksize, dtype=str):
+            codes = names.encode(chunk[0].values, grow=False)
+            keep = codes != -1
+            anno_name.append(codes[keep])
+            anno_cat.append(categories.encode(chunk[1].fillna('Unknown').values[keep]))
+    anno_name = np.concatenate(anno_name)
+    anno_cat = np.concatenate(anno_cat)
+    unknown = categories.encode(np.array(['Unknown'], dtype=object))[0]
+
+    # group the annotation by name, keeping the file order within a name
+    order = np.argsort(anno_name, kind='mergesort')
+    anno_name, anno_cat = anno_name[order], np.r_[anno_cat[order], unknown]
+    first = np.searchsorted(anno_name, np.arange(len(names.values)))
+    count = np.bincount(anno_name, minlength=len(names.values))[feat['name']]
+
+    # one row for each category of a feature, or a single Unknown row
+    k = np.maximum(count, 1)
+    rows = np.repeat(np.arange(len(feat['name'])), k)
+    pos = np.repeat(first[feat['name']] - np.cumsum(k) + k, k) + np.arange(k.sum())
+    pos[np.repeat(count == 0, k)] = len(anno_name)
+    cat = anno_cat[pos]
+
+    # keep the first row of each (name, category) pair
+    key = feat['name'][rows].astype(np.int64) * len(categories.values) + cat
+    keep = np.sort(np.unique(key, return_index=True)[1])
+    rows, cat = rows[keep], cat[keep]
+
+    pdtable = pd.DataFrame({'chr': chroms.decode(feat['chr'][rows]),
+                            'start': feat['start'][rows],
+                            'end': feat['end'][rows],
+                            'name': names.decode(feat['name'][rows]),
+                            'score': scores.decode(feat['score'][rows]),
+                            'strand': strands.decode(feat['strand'][rows]),
+                            'category': categories.decode(cat)},
+                           columns=TABLE_COLUMNS)
+
+    return pdtable, len(names.values)
+
+
+def write_index(pdtable, path):
+    """Save the table made by build_table as a directory of .npy columns.
+
+    Coordinates are stored as they are, strings as integer codes plus the
+    list of their distinct values, so that every file can be memory mapped.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for column in TABLE_COLUMNS:
+        values = pdtable[column].values
+        if column in ['start', 'end']:
+            dtype = np.int32 if len(values) == 0 or values.max() <= np.iinfo(np.int32).max else np.int64
+            np.save(os.path.join(path, column + '.npy'), values.astype(dtype))
+        else:
+            codes, levels = pd.factorize(values)
+            np.save(os.path.join(path, column + '.npy'), codes.astype(np.int32))
+            np.save(os.path.join(path, column + '.levels.npy'), np.array([str(level) for level in levels]))
+
+
+def read_index(path):
+    """Load a table saved by write_index; return it with the number of unique feature names."""
+    columns = {}
+    for column in TABLE_COLUMNS:
+        values = np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+        if column in ['start', 'end']:
+            columns[column] = values
+        elif column in ['chr', 'category']:
+            # grouped columns point to one shared string per distinct value
+            # (as chunked_table), unused categorical levels would be grouped too
+            levels = np.load(os.path.join(path, column + '.levels.npy')).astype(object)
+            columns[column] = levels.take(values)
+        else:
+            # categoricals keep the codes as they are, instead of one object per row
+            levels = np.load(os.path.join(path, column + '.levels.npy')).astype(object)
+            columns[column] = pd.Categorical.from_codes(values, levels)
+            if column == 'name':
+                n = len(levels)
+
+    return pd.DataFrame(columns, columns=TABLE_COLUMNS), n
+
+
+def _digest(*texts):
+    """Hex md5 of the given strings."""
+    md5 = hashlib.md5()
+    for text in texts:
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        md5.update(text)
+    return md5.hexdigest()
+
+
+def category_digests(pdTbl, catList, params):
+    """Fingerprint the features of each category together with the run parameters.
+
+    The digest of a category only depends on params and on the position and
+    name of its features, neither on the other categories nor on the order of
+    the rows, so it is unchanged when the annotation of other categories is.
+    """
+    rows = (pdTbl.chr.astype(str) + '\t' + pdTbl.start.astype(str) + '\t' +
+            pdTbl.end.astype(str) + '\t' + pdTbl.name.astype(str)).values
+    groups = pdTbl.groupby('category', sort=False).indices
+
+    return dict((category, _digest(params, '\n', '\n'.join(np.sort(rows[groups.get(category, [])]))))
+                for category in catList)
+
+
+def read_state(path):
+    """Load the digests and raw clusters saved by write_state, if any."""
+    digests, table = {}, pd.DataFrame(columns=range(5))
+
+    digests_fn = os.path.join(path, 'digests.tsv')
+    if os.path.exists(digests_fn) and os.path.getsize(digests_fn) > 0:
+        saved = pd.read_table(digests_fn, header=None, dtype=str)
+        digests = dict(zip(saved[0], saved[1]))
+
+    clusters_fn = os.path.join(path, 'clusters.tsv')
+    if os.path.exists(clusters_fn) and os.path.getsize(clusters_fn) > 0:
+        table = pd.read_table(clusters_fn, header=None, dtype={0: str, 4: str})
+
+    return digests, table
+
+
+def write_state(path, digests, table):
+    """Save the digests of the categories and their raw clusters (as joined by collect)."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    saved = pd.DataFrame({0: list(digests.keys()), 1: list(digests.values())}, columns=[0, 1])
+    saved.to_csv(os.path.join(path, 'digests.tsv'), sep='\t', header=False, index=False)
+    table.to_csv(os.path.join(path, 'clusters.tsv'), sep='\t', header=False, index=False)
+
+
+def cache_read(path, digests):
+    """Raw clusters cached by cache_write for each category of digests.
+
+    Returns a dictionary of the categories found, marking their files as
+    recently used.
+    """
+    hits = {}
+    for category, digest in digests.items():
+        fn = os.path.join(path, digest + '.tsv')
+        try:
+            os.utime(fn, None)
+            if os.path.getsize(fn) == 0:
+                table = pd.DataFrame(columns=range(5))
+            else:
+                table = pd.read_table(fn, header=None, dtype={0: str, 4: str})
+        except (IOError, OSError):
+            continue
+        # categories with the same features share their clusters
+        table[4] = category
+        hits[category] = table
+
+    return hits
+
+
+def cache_write(path, digests, table, max_bytes):
+    """Cache the raw clusters of each category of digests, then evict the least recently used beyond max_bytes.
+
+    Many processes may share the cache: each one writes to its own temp file
+    before renaming it, and files removed meanwhile by the others are skipped.
+    """
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    groups = {} if table.empty else table.groupby(4, sort=False).indices
+    for category, digest in digests.items():
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=path)
+        with os.fdopen(fd, 'w') as out:
+            # categories without clusters are cached as empty files
+            table.iloc[groups.get(category, [])].to_csv(out, sep='\t', header=False, index=False)
+        os.rename(tmp, os.path.join(path, digest + '.tsv'))
+
+    cached = []
+    for fn in os.listdir(path):
+        if fn.endswith('.tsv'):
+            fn = os.path.join(path, fn)
+            try:
+                cached.append((os.path.getmtime(fn), os.path.getsize(fn), fn))
+            except OSError:
+                continue
+
+    total = sum(size for mtime, size, fn in cached)
+    for mtime, size, fn in sorted(cached):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,150 @@
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import pybedtools
+import pybedtools.bedtool
+
+
+# bedtools invocations of this process, current stage, per-category timings
+# and largest size of the temp files alive at once
+_state = {'calls': 0, 'stage': None, 'categories': None, 'temp_peak': 0}
+
+
+def _counted(call_bedtools):
+    """Count the calls to pybedtools' call_bedtools."""
+    def wrapper(*args, **kwargs):
+        _state['calls'] += 1
+        return call_bedtools(*args, **kwargs)
+    wrapper.counted = True
+    return wrapper
+
+
+def bedtools_calls():
+    """Number of bedtools invocations made so far by this process."""
+    return _state['calls']
+
+
+def category_timer(category):
+    """Start timing a category; return the function recording its time, None when not profiling."""
+    if _state['categories'] is None:
+        return None
+
+    wall, calls = time.time(), _state['calls']
+
+    def done():
+        _state['categories'].append((category, _state['stage'], time.time() - wall, _state['calls'] - calls))
+    return done
+
+
+def record_tempfiles(size):
+    """Keep the largest size in bytes of the temp files alive at once in this process."""
+    _state['temp_peak'] = max(_state['temp_peak'], size)
+
+
+def temp_peak():
+    """Largest size in bytes of the temp files alive at once, in this process or in one of its workers."""
+    return _state['temp_peak']
+
+
+def drain_worker():
+    """Take the category timings, bedtools calls and temp files peak recorded by this process (a worker)."""
+    timings = None
+    if _state['categories'] is not None:
+        timings = list(_state['categories'])
+        del _state['categories'][:]
+    drained = timings, _state['calls'], _state['temp_peak']
+    _state['calls'] = 0
+    _state['temp_peak'] = 0
+    return drained
+
+
+def merge_worker(drained):
+    """Add the category timings, bedtools calls and temp files peak of a worker to this process."""
+    timings, calls, peak = drained
+    if timings is not None and _state['categories'] is not None:
+        _state['categories'].extend(timings)
+    _state['calls'] += calls
+    _state['temp_peak'] = max(_state['temp_peak'], peak)
+
+
+def peak_rss(who=None):
+    """Peak resident memory in MB so far of this process (RUSAGE_SELF), of its waited children (RUSAGE_CHILDREN) or of both (None)."""
+    whos = [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN] if who is None else [who]
+    peaks = [resource.getrusage(who).ru_maxrss for who in whos]
+    # kilobytes on Linux, bytes on Mac OS
+    return max(peaks) / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10)
+
+
+class Profiler(object):
+    """Wall time, CPU time, peak memory and bedtools calls of each stage of a run.
+
+    CPU time includes the waited children (bedtools and worker processes).
+    Peak memory is the highest resident memory of the run at the end of the
+    stage, so a stage raising it is the one using most memory.
+    """
+
+    def __init__(self, enabled=True, top=20):
+        self.enabled = enabled
+        self.top = top
+        self.stages = []
+        if not enabled:
+            return
+        _state['categories'] = []
+        if not getattr(pybedtools.bedtool.call_bedtools, 'counted', False):
+            pybedtools.bedtool.call_bedtools = _counted(pybedtools.bedtool.call_bedtools)
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code run within the with block."""
+        if not self.enabled:
+            yield
+            return
+
+        _state['stage'] = name
+        wall, cpu, calls = time.time(), sum(os.times()[:4]), _state['calls']
+        try:
+            yield
+        finally:
+            self.stages.append({'stage': name,
+                                'wall_s': round(time.time() - wall, 4),
+                                'cpu_s': round(sum(os.times()[:4]) - cpu, 4),
+                                'peak_rss_mb': round(peak_rss(), 1),
+                                'bedtools_calls': _state['calls'] - calls})
+            _state['stage'] = None
+
+    def report(self):
+        """The stages and the slowest categories as a dictionary."""
+        slowest = sorted(_state['categories'], key=lambda timing: timing[2], reverse=True)[:self.top]
+        return {'stages': self.stages,
+                'total_wall_s': round(sum(stage['wall_s'] for stage in self.stages), 4),
+                'bedtools_calls': sum(stage['bedtools_calls'] for stage in self.stages),
+                'temp_peak_mb': round(temp_peak() / 2.0 ** 20, 1),
+                'slowest_categories': [{'category': category, 'stage': stage, 'wall_s': round(wall, 4),
+                                        'bedtools_calls': calls} for category, stage, wall, calls in slowest]}
+
+    def write(self, file_name):
+        """Save the report as JSON."""
+        with open(file_name, 'w') as out:
+            json.dump(self.report(), out, indent=2, sort_keys=True, separators=(',', ': '))
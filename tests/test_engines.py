@@ -0,0 +1,93 @@
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Parity of the NumPy and bedtools engines on the tutorial data.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from distutils.spawn import find_executable
+
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from clusterscan import scan
+
+TUTORIAL = os.path.join(ROOT, 'tutorial')
+FEATURES = os.path.join(TUTORIAL, 'Homo_sapiens.GRCh38.85_genes.bed')
+ANNOTATION = os.path.join(TUTORIAL, 'Homo_sapiens.GRCh38.85_Pfam.txt')
+
+
+def comparable(results, name):
+    """Rows of a result table as sorted strings, clusters known by their position instead of their id."""
+    df = results[name].copy()
+    if df.empty:
+        return []
+    if 'cluster_id' in df.columns and name != 'clusters':
+        clusters = results['clusters'].set_index('cluster_id')
+        df['cluster_id'] = (clusters.chr.astype(str) + ':' + clusters.start.astype(str) + '-' +
+                            clusters.end.astype(str)).reindex(df.cluster_id.values).values
+    elif name == 'clusters':
+        df = df.drop('cluster_id', axis=1)
+    return sorted(tuple(str(value) for value in row) for row in df.itertuples(index=False))
+
+
+class EngineParity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.features = pd.read_table(FEATURES, header=None, dtype={0: str})
+        cls.annotation = pd.read_table(ANNOTATION, header=None)
+        # a few categories keep the bedtools runs short
+        cls.categories = sorted(cls.annotation[1].dropna().unique())[:25]
+
+    def assert_same(self, method, **params):
+        runs = [scan(self.features, self.annotation, method, categories=self.categories, singletons=True,
+                     engine=engine, **params) for engine in ['numpy', 'bedtools']]
+        self.assertFalse(runs[0]['clusters'].empty)
+        for name in ['clusters', 'features', 'bystanders', 'summary', 'singletons']:
+            self.assertEqual(comparable(runs[0], name), comparable(runs[1], name), name)
+
+    @unittest.skipIf(find_executable('bedtools') is None, 'bedtools is not installed')
+    def test_clusterdist(self):
+        self.assert_same('dist', dist=100000)
+
+    @unittest.skipIf(find_executable('bedtools') is None, 'bedtools is not installed')
+    def test_clustermean(self):
+        self.assert_same('mean', window=100000, slide=50000)
+
+    @unittest.skipIf(find_executable('bedtools') is None, 'bedtools is not installed')
+    def test_clustermean_extension_above_seed(self):
+        self.assert_same('mean', window=100000, slide=50000, seed=1, extension=3)
+
+    def test_no_extension_window(self):
+        # features in one window out of four: every one is a seed (k=1) but
+        # none passes the extension threshold (e=3)
+        features = pd.DataFrame([['1', 400 * i + 10, 400 * i + 20, 'g%d' % i, 0, '+'] for i in range(10)])
+        annotation = pd.DataFrame([['g%d' % i, 'A'] for i in range(10)])
+        results = scan(features, annotation, 'mean', window=100, slide=100, seed=1, extension=3)
+        self.assertTrue(results['clusters'].empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
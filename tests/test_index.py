@@ -0,0 +1,72 @@
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Analyses run on a table saved by the index command."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import clusterscan
+from algos import collect, do_clustermean, mean_windows
+from loader import join_table, read_index, write_index
+
+
+class UnannotatedChromosome(unittest.TestCase):
+
+    def setUp(self):
+        # chromosome 2 only holds features without category (e.g. unplaced scaffolds)
+        features = pd.DataFrame([['1', 1000 * i, 1000 * i + 100, 'a%d' % i, 0, '+'] for i in range(20)] +
+                                [['2', 1000 * i, 1000 * i + 100, 'b%d' % i, 0, '+'] for i in range(5)])
+        annotation = pd.DataFrame([['a%d' % i, 'A' if i < 5 else 'B'] for i in range(20)])
+        self.path = tempfile.mkdtemp()
+        write_index(join_table(features, annotation)[0], self.path)
+        pdtable, n = read_index(self.path)
+        self.pdtable = pdtable[pdtable['category'] != 'Unknown']
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_windows(self):
+        windows = mean_windows(self.pdtable, {'--window': '2000', '--slide': '1000'})
+        self.assertEqual([scaffold for scaffold, starts, ends in windows], ['1'])
+        self.assertTrue(all(ends.dtype.kind == 'i' for scaffold, starts, ends in windows))
+
+    def test_clustermean(self):
+        sargs = {'--window': '2000', '--slide': '1000', '--seed': '1', '--extension': '0', '--engine': 'numpy'}
+        table = collect(do_clustermean(['A', 'B'], self.pdtable, sargs))
+        self.assertFalse(table.empty)
+        self.assertEqual(sorted(table[4].unique()), ['A'])
+        self.assertTrue(np.issubdtype(table[1].dtype, np.integer))
+
+    def test_run_params(self):
+        clusterscan.arguments = {'clusterdist': False, '--window': '2000', '--slide': '1000', '--seed': '3',
+                                 '--extension': '2', '--engine': 'numpy'}
+        self.assertTrue(clusterscan.run_params(self.pdtable).endswith(' 1:19100'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# Copyright (C) 2017-2018 Massimiliano Volpe and Marco Miralto
+
+# This file is part of ClusterScan.
+
+# ClusterScan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# ClusterScan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ClusterScan.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""P-values and FDR of the permutation test."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from algos import bh_fdr, empirical_pvalues, find_clusters, permutation_test
+
+
+class PValues(unittest.TestCase):
+
+    def test_empirical_pvalues(self):
+        observed = np.array([3, 0, 5])
+        batches = [np.array([[3, 1, 2], [2, 0, 6]]), np.array([[4, 0, 0]])]
+        np.testing.assert_allclose(empirical_pvalues(observed, batches), [3 / 4.0, 4 / 4.0, 2 / 4.0])
+
+    def test_bh_fdr(self):
+        # sorted p * n / rank: .04, .06, .0533, .2, then the running minimum from the top
+        np.testing.assert_allclose(bh_fdr([0.01, 0.04, 0.03, 0.2]), [0.04, 0.16 / 3, 0.16 / 3, 0.2])
+        np.testing.assert_allclose(bh_fdr([0.5, 0.9, 0.9]), [0.9, 0.9, 0.9])
+        self.assertEqual(len(bh_fdr([])), 0)
+
+    def test_permutation_test(self):
+        # category A holds the only tight run of features, the others are spread
+        rows = [['1', 10 * i, 10 * i + 5, 'a%d' % i, 0, '+', 'A'] for i in range(5)]
+        rows += [['1', 1000 * (i + 1), 1000 * (i + 1) + 5, 'f%d' % i, 0, '+', 'BCDE'[i % 4]] for i in range(40)]
+        pdtable = pd.DataFrame(rows, columns=['chr', 'start', 'end', 'name', 'score', 'strand', 'category'])
+        l = ['A', 'B', 'C', 'D', 'E']
+        sargs = {'--engine': 'numpy', '--dist': '50'}
+
+        table = find_clusters('dist', l, pdtable, sargs)
+        pvalues = permutation_test('dist', l, pdtable, table, sargs, 2, 19, seed=1)
+        self.assertEqual(list(pvalues.category), l)
+        self.assertAlmostEqual(pvalues.p_value[0], 1 / 20.0)
+        # categories without clusters are never beaten by a shuffle
+        self.assertTrue((pvalues.p_value[1:] == 1).all())
+        np.testing.assert_allclose(pvalues.fdr, bh_fdr(pvalues.p_value))
+
+
+if __name__ == '__main__':
+    unittest.main()